@@ -1,45 +1,69 @@
 from __future__ import annotations
 
 import hmac
+import io
+import re
+import shutil
 import textwrap
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
 from pathlib import Path
 from datetime import datetime
 
 from sqlalchemy import create_engine, text as sqltext
 from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import plotly.express as px
 import plotly.graph_objects as go
 
 
-def md_html(html: str) -> None:
+def clean_html(html: str) -> str:
     s = textwrap.dedent(html).strip()
-    s = "\n".join(line.lstrip() for line in s.splitlines())
-    st.markdown(s, unsafe_allow_html=True)
+    return "\n".join(line.lstrip() for line in s.splitlines())
+
+
+def md_html(html: str) -> None:
+    st.markdown(clean_html(html), unsafe_allow_html=True)
 
 
 # =========================
 # localStorage helpers
 # =========================
 def localstorage_get(key: str, default: str = "") -> str:
+    # Valeur déjà résolue pour cette session : pas de nouvel iframe JS.
+    state_key = "ls_" + key
+    if state_key in st.session_state:
+        return st.session_state[state_key]
+
+    v = st.query_params.get(state_key)
+    if v is not None:
+        st.session_state[state_key] = v
+        del st.query_params[state_key]
+        return v
+
     components.html(
         f"""
         <script>
         const v = window.localStorage.getItem({key!r}) || {default!r};
         const url = new URL(window.location);
-        url.searchParams.set({("ls_" + key)!r}, v);
+        url.searchParams.set({state_key!r}, v);
         window.history.replaceState(null, "", url.toString());
         </script>
         """,
         height=0,
     )
-    return st.query_params.get("ls_" + key, default)
+    return default
 
 
 def localstorage_set(key: str, value: str) -> None:
+    st.session_state["ls_" + key] = value
     components.html(
         f"""
         <script>
@@ -57,6 +81,7 @@ SUPABASE_DB_URL = st.secrets.get("SUPABASE_DB_URL") or st.secrets.get("DATABASE_
 LOGO_PATH = Path("assets/multirex.jpg")
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+CACHE_DIR = Path(".cache")
 
 COLORS = {
     "primary": "#6366f1",
@@ -71,8 +96,7 @@ COLORS = {
 # =========================
 # CSS
 # =========================
-def inject_custom_css():
-    md_html(
+_CSS_HTML = clean_html(
         """
         <style>
         @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700;800&display=swap');
@@ -224,7 +248,7 @@ def inject_custom_css():
         #MainMenu {visibility: hidden;}
         footer {visibility: hidden;}
         header {visibility: hidden;}
-        * Style pour la carte de recherche par plaque */
+        /* Style pour la carte de recherche par plaque */
         .plaque-card {
             background: white;
             border-radius: 16px;
@@ -261,9 +285,45 @@ def inject_custom_css():
                 0 4px 6px rgba(0, 0, 0, 0.2),
                 inset 0 2px 4px rgba(255, 255, 255, 0.2);
         }
+
+        /* Cartes des besoins (page casse) : styles partagés, la carte ne porte que des classes */
+        .besoin-card {
+            background: white; border-left: 6px solid var(--urg); border-radius: 14px;
+            padding: 14px; margin-bottom: 12px; box-shadow: 0 2px 10px rgba(0,0,0,0.08);
+        }
+        .urg-high { --urg: #dc2626; --urg-bg: #fee2e2; }
+        .urg-mid  { --urg: #d97706; --urg-bg: #fef3c7; }
+        .urg-ok   { --urg: #059669; --urg-bg: #d1fae5; }
+        .besoin-head { display: flex; justify-content: space-between; align-items: center; gap: 12px; }
+        .besoin-id { display: flex; align-items: center; gap: 10px; }
+        .besoin-code {
+            font-family: monospace; font-weight: 900; font-size: 20px;
+            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+            color: white; padding: 8px 12px; border-radius: 10px;
+        }
+        .besoin-badge {
+            background: var(--urg-bg); color: var(--urg); padding: 6px 10px;
+            border-radius: 10px; font-weight: 700; font-size: 12px;
+        }
+        .besoin-price { text-align: right; }
+        .besoin-price-label { font-size: 11px; color: #6b7280; font-weight: 700; }
+        .besoin-price-value { font-size: 18px; color: #111827; font-weight: 900; }
+        .besoin-tags { margin-top: 10px; display: flex; gap: 12px; flex-wrap: wrap; }
+        .besoin-tag { padding: 6px 12px; border-radius: 8px; font-size: 13px; font-weight: 600; }
+        .tag-marque  { background: #f3f4f6; color: #374151; }
+        .tag-energie { background: #fef3c7; color: #92400e; }
+        .tag-modele  { background: #e0e7ff; color: #3730a3; }
+        .besoin-desc {
+            margin-top: 10px; background: #f9fafb; padding: 10px; border-radius: 10px;
+            color: #111827; font-weight: 800; font-size: 14px;
+        }
         </style>
         """
-    )
+)
+
+
+def inject_custom_css():
+    st.markdown(_CSS_HTML, unsafe_allow_html=True)
 
 
 # =========================
@@ -274,11 +334,7 @@ def show_logo(width: int = 200):
         st.image(str(LOGO_PATH), width=width)
 
 
-def check_password() -> bool:
-    if st.session_state.get("authenticated") is True:
-        return True
-
-    md_html(
+_LOGIN_CSS_HTML = clean_html(
         """
         <style>
         section[data-testid="stSidebar"] { display: none; }
@@ -319,12 +375,9 @@ def check_password() -> bool:
         }
         </style>
         """
-    )
+)
 
-    inject_custom_css()
-    md_html("<div style='height: 20px;'></div>")
-
-    md_html(
+_LOGIN_HEADER_HTML = clean_html(
         """
         <div style='text-align: center; margin-bottom: 40px;'>
             <div style='font-size: 60px; margin-bottom: 16px;'>🚗</div>
@@ -342,9 +395,9 @@ def check_password() -> bool:
             '>Système de gestion intelligent</p>
         </div>
         """
-    )
+)
 
-    md_html(
+_LOGIN_TITLE_HTML = clean_html(
         """
             <h2 style='
                 color: #111827;
@@ -359,7 +412,45 @@ def check_password() -> bool:
             '>Accédez à votre tableau de bord</p>
         </div>
         """
-    )
+)
+
+_LOGIN_FOOTER_HTML = clean_html(
+        """
+        <div style='text-align: center; margin-top: 32px;'>
+            <div style='
+                display: inline-flex;
+                gap: 12px;
+                background: rgba(255, 255, 255, 0.95);
+                padding: 12px 24px;
+                border-radius: 50px;
+                box-shadow: 0 4px 6px rgba(0, 0, 0, 0.07);
+            '>
+                <span style='color: #667eea; font-weight: 600; font-size: 13px;'>📊 Analytics</span>
+                <span style='color: #667eea; font-weight: 600; font-size: 13px;'>⚡ Temps réel</span>
+                <span style='color: #667eea; font-weight: 600; font-size: 13px;'>🔒 Sécurisé</span>
+            </div>
+            <p style='
+                color: rgba(255, 255, 255, 0.8);
+                margin-top: 24px;
+                font-size: 13px;
+            '>Multirex Auto © 2025</p>
+        </div>
+        """
+)
+
+
+def check_password() -> bool:
+    if st.session_state.get("authenticated") is True:
+        return True
+
+    st.markdown(_LOGIN_CSS_HTML, unsafe_allow_html=True)
+
+    inject_custom_css()
+    md_html("<div style='height: 20px;'></div>")
+
+    st.markdown(_LOGIN_HEADER_HTML, unsafe_allow_html=True)
+
+    st.markdown(_LOGIN_TITLE_HTML, unsafe_allow_html=True)
 
     user = st.text_input("Utilisateur", key="login_user", placeholder="IDENTIFIANT")
     pwd = st.text_input("Mot de passe", type="password", key="login_pwd", placeholder="Votre mot de passe")
@@ -394,29 +485,7 @@ def check_password() -> bool:
 
     md_html("</div>")
 
-    md_html(
-        """
-        <div style='text-align: center; margin-top: 32px;'>
-            <div style='
-                display: inline-flex;
-                gap: 12px;
-                background: rgba(255, 255, 255, 0.95);
-                padding: 12px 24px;
-                border-radius: 50px;
-                box-shadow: 0 4px 6px rgba(0, 0, 0, 0.07);
-            '>
-                <span style='color: #667eea; font-weight: 600; font-size: 13px;'>📊 Analytics</span>
-                <span style='color: #667eea; font-weight: 600; font-size: 13px;'>⚡ Temps réel</span>
-                <span style='color: #667eea; font-weight: 600; font-size: 13px;'>🔒 Sécurisé</span>
-            </div>
-            <p style='
-                color: rgba(255, 255, 255, 0.8);
-                margin-top: 24px;
-                font-size: 13px;
-            '>Multirex Auto © 2025</p>
-        </div>
-        """
-    )
+    st.markdown(_LOGIN_FOOTER_HTML, unsafe_allow_html=True)
 
     return False
 
@@ -436,11 +505,42 @@ def get_engine() -> Engine:
     if not url:
         st.error("SUPABASE_DB_URL (ou DATABASE_URL / POSTGRES_URL) manquant dans .streamlit/secrets.toml")
         st.stop()
-    return create_engine(url, pool_pre_ping=True, pool_size=5, max_overflow=10)
+    # Pas de pre_ping (un SELECT 1 par checkout, mal vécu par PgBouncer en mode
+    # transaction) : recyclage court + une relance dans retry_on_disconnect.
+    return create_engine(
+        url,
+        pool_pre_ping=False,
+        pool_size=10,
+        max_overflow=5,
+        pool_recycle=60,
+        connect_args={"keepalives": 1, "keepalives_idle": 30},
+    )
 
 
-@st.cache_data(show_spinner=False, ttl=300)
-def sql_df(query: str, params: dict | None = None) -> pd.DataFrame:
+def retry_on_disconnect(fn):
+    # Une seule relance, et uniquement si SQLAlchemy a invalidé la connexion
+    # (coupure réseau / pooler). Réservé aux lectures (sql_df, fetch_one) :
+    # rejouer une lecture est sans effet de bord.
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except OperationalError as e:
+            if not e.connection_invalidated:
+                raise
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+# Pas de cache ici : ce sont les getters réutilisés qui portent leur propre
+# @st.cache_data (TTL adapté), les sondes ponctuelles n'ont pas à polluer le cache.
+@retry_on_disconnect
+def sql_df(
+    query: str,
+    params: dict | None = None,
+    chunksize: int | None = None,
+    dtypes: dict | None = None,
+) -> pd.DataFrame:
     q = (query or "").lstrip().lower()
     if not (q.startswith("select") or q.startswith("with")):
         raise ValueError(
@@ -448,11 +548,30 @@ def sql_df(query: str, params: dict | None = None) -> pd.DataFrame:
             "Utilise exec_sql() ou exec_sql_scalar() pour écrire en base."
         )
 
+    eng = get_engine()
+    if chunksize:
+        # Curseur serveur : les lignes arrivent par paquets au lieu d'être
+        # toutes matérialisées en listes Python avant le DataFrame.
+        with eng.connect().execution_options(stream_results=True, max_row_buffer=chunksize) as conn:
+            chunks = list(pd.read_sql_query(sqltext(query), conn, params=params or {}, chunksize=chunksize, dtype=dtypes))
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+
+    # dtypes : types compacts par colonne (ex. compteurs en int32) appliqués à la lecture
+    with eng.connect() as conn:
+        return pd.read_sql_query(sqltext(query), conn, params=params or {}, dtype=dtypes)
+
+
+@retry_on_disconnect
+def fetch_one(query: str, params: dict | None = None) -> dict | None:
+    # Lecture d'une seule ligne : Row -> dict directement, sans passer par un DataFrame
     eng = get_engine()
     with eng.connect() as conn:
-        return pd.read_sql_query(sqltext(query), conn, params=params or {})
+        row = conn.execute(sqltext(query), params or {}).mappings().first()
+    return dict(row) if row else None
 
 
+# Pas de retry_on_disconnect sur les écritures : une coupure après le COMMIT
+# côté serveur mais avant l'accusé côté client rejouerait un INSERT/UPDATE.
 def exec_sql(query: str, params: dict | None = None) -> None:
     eng = get_engine()
     with eng.begin() as conn:
@@ -482,26 +601,13 @@ def save_uploaded_file(file_obj, prefix: str, ext: str) -> str | None:
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
     fname = f"{prefix}_{ts}.{ext}"
     path = UPLOAD_DIR / fname
-    with open(path, "wb") as f:
-        f.write(file_obj.getvalue())
+    # Copie par blocs de 64 Kio : évite la copie complète en bytes de getvalue()
+    file_obj.seek(0)
+    with open(path, "wb", buffering=1024 * 1024) as f:
+        shutil.copyfileobj(file_obj, f, length=65536)
     return str(path)
 
 
-def add_column_if_missing(table: str, col_def: str):
-    col_name = col_def.split()[0]
-    q = """
-    SELECT 1
-    FROM information_schema.columns
-    WHERE table_schema = 'public'
-      AND table_name = :t
-      AND column_name = :c
-    LIMIT 1
-    """
-    exists = not sql_df(q, {"t": table, "c": col_name}).empty
-    if not exists:
-        exec_sql(f"ALTER TABLE {table} ADD COLUMN {col_def};")
-
-
 # =========================
 # Tables casses
 # =========================
@@ -523,6 +629,7 @@ def exec_sql_scalar(query: str, params: dict | None = None):
 
 
 def ensure_breaker_tables():
+    # Un seul script DDL : PostgreSQL exécute les statements à la suite (1 aller-retour).
     exec_sql(
         """
         CREATE TABLE IF NOT EXISTS public.breakers (
@@ -530,11 +637,7 @@ def ensure_breaker_tables():
           name TEXT NOT NULL UNIQUE,
           created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
         );
-        """
-    )
 
-    exec_sql(
-        """
         CREATE TABLE IF NOT EXISTS public.breaker_click_offers (
           id BIGSERIAL PRIMARY KEY,
           breaker_id BIGINT NOT NULL REFERENCES public.breakers(id) ON DELETE CASCADE,
@@ -554,11 +657,7 @@ def ensure_breaker_tables():
           audio_path TEXT,
           created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
         );
-        """
-    )
 
-    exec_sql(
-        """
         CREATE TABLE IF NOT EXISTS public.breaker_free_offers (
           id BIGSERIAL PRIMARY KEY,
           breaker_id BIGINT NOT NULL REFERENCES public.breakers(id) ON DELETE CASCADE,
@@ -572,42 +671,127 @@ def ensure_breaker_tables():
           audio_path TEXT,
           created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
         );
+
+        -- Migration des tables créées avant l'ajout de ces colonnes
+        ALTER TABLE public.breaker_click_offers
+          ADD COLUMN IF NOT EXISTS immatriculation TEXT,
+          ADD COLUMN IF NOT EXISTS vin TEXT,
+          ADD COLUMN IF NOT EXISTS photo_moteur_path TEXT,
+          ADD COLUMN IF NOT EXISTS photo_plaque_path TEXT,
+          ADD COLUMN IF NOT EXISTS audio_path TEXT;
+
+        ALTER TABLE public.breaker_free_offers
+          ADD COLUMN IF NOT EXISTS immatriculation TEXT,
+          ADD COLUMN IF NOT EXISTS vin TEXT,
+          ADD COLUMN IF NOT EXISTS photo_moteur_path TEXT,
+          ADD COLUMN IF NOT EXISTS photo_plaque_path TEXT,
+          ADD COLUMN IF NOT EXISTS audio_path TEXT;
+
+        -- Top-N "offres récentes" (ORDER BY id DESC LIMIT) servi par l'index,
+        -- colonnes de la liste en INCLUDE pour limiter les accès au heap
+        CREATE INDEX IF NOT EXISTS idx_bco_id_desc ON public.breaker_click_offers (id DESC)
+          INCLUDE (breaker_id, created_at, code_moteur, marque, energie, prix_demande, qty);
+        CREATE INDEX IF NOT EXISTS idx_bfo_id_desc ON public.breaker_free_offers (id DESC)
+          INCLUDE (breaker_id, created_at, prix_demande);
+
+        -- Compteurs du jour par casse (get_breaker_stats_today)
+        CREATE INDEX IF NOT EXISTS idx_bco_breaker_created ON public.breaker_click_offers (breaker_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_bfo_breaker_created ON public.breaker_free_offers (breaker_id, created_at);
         """
     )
 
-    for col in [
-        "immatriculation TEXT",
-        "vin TEXT",
-        "photo_moteur_path TEXT",
-        "photo_plaque_path TEXT",
-        "audio_path TEXT",
-    ]:
-        add_column_if_missing("breaker_click_offers", col)
-        add_column_if_missing("breaker_free_offers", col)
-
 
 def get_or_create_breaker(name: str) -> int:
     name = (name or "").strip()
     if not name:
         raise ValueError("Nom casse vide")
 
-    # First, try to find existing breaker
-    q_select = """
-    SELECT id FROM public.breakers WHERE name = :name LIMIT 1;
-    """
-    df = sql_df(q_select, {"name": name})
-    
-    if not df.empty:
-        return int(df.iloc[0]["id"])
-    
-    # If not found, insert new one
-    q_insert = """
+    # Upsert : un seul aller-retour, atomique (pas de course entre SELECT et INSERT).
+    # Le DO UPDATE no-op force le RETURNING id même quand la casse existe déjà.
+    q = """
     INSERT INTO public.breakers(name)
     VALUES (:name)
+    ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name
     RETURNING id;
     """
-    breaker_id = exec_sql_scalar(q_insert, {"name": name})
-    return int(breaker_id)
+    return int(exec_sql_scalar(q, {"name": name}))
+
+
+_CLICK_OFFER_COLS = (
+    "breaker_id", "code_moteur", "marque", "energie", "type_nom", "type_modele", "type_annee",
+    "prix_demande", "qty", "note", "immatriculation", "vin", "photo_moteur_path", "photo_plaque_path", "audio_path",
+)
+_FREE_OFFER_COLS = (
+    "breaker_id", "texte", "prix_demande", "note", "immatriculation", "vin",
+    "photo_moteur_path", "photo_plaque_path", "audio_path",
+)
+
+
+def insert_click_offers_bulk(rows: list[dict]) -> None:
+    """
+    Insère plusieurs offres en un seul aller-retour (executemany SQLAlchemy).
+    Chaque dict reprend les arguments de insert_click_offer (clés optionnelles à None).
+    """
+    if not rows:
+        return
+    params = []
+    for r in rows:
+        p = {c: r.get(c) for c in _CLICK_OFFER_COLS}
+        p["breaker_id"] = int(p["breaker_id"])
+        p["code_moteur"] = (p["code_moteur"] or "").strip().upper()
+        p["qty"] = int(p["qty"] if p["qty"] is not None else 1)
+        params.append(p)
+
+    with get_engine().begin() as conn:
+        conn.execute(
+            sqltext(
+                """
+                INSERT INTO breaker_click_offers(
+                  breaker_id, code_moteur, marque, energie, type_nom, type_modele, type_annee,
+                  prix_demande, qty, note, immatriculation, vin, photo_moteur_path, photo_plaque_path, audio_path
+                ) VALUES(
+                  :breaker_id, :code_moteur, :marque, :energie, :type_nom, :type_modele, :type_annee,
+                  :prix_demande, :qty, :note, :immatriculation, :vin, :photo_moteur_path, :photo_plaque_path, :audio_path
+                )
+                """
+            ),
+            params,
+        )
+    # Invalidation ciblée : la liste des offres et les compteurs du jour reflètent
+    # l'écriture sans attendre le TTL
+    get_recent_click_offers.clear()
+    get_breaker_stats_today.clear()
+
+
+def insert_free_offers_bulk(rows: list[dict]) -> None:
+    """
+    Insère plusieurs offres libres en un seul aller-retour (executemany SQLAlchemy).
+    """
+    if not rows:
+        return
+    params = []
+    for r in rows:
+        p = {c: r.get(c) for c in _FREE_OFFER_COLS}
+        p["breaker_id"] = int(p["breaker_id"])
+        p["texte"] = (p["texte"] or "").strip()
+        params.append(p)
+
+    with get_engine().begin() as conn:
+        conn.execute(
+            sqltext(
+                """
+                INSERT INTO breaker_free_offers(
+                  breaker_id, texte, prix_demande, note, immatriculation, vin, photo_moteur_path, photo_plaque_path, audio_path
+                )
+                VALUES(
+                  :breaker_id, :texte, :prix_demande, :note, :immatriculation, :vin, :photo_moteur_path, :photo_plaque_path, :audio_path
+                )
+                """
+            ),
+            params,
+        )
+    get_recent_free_offers.clear()
+    get_breaker_stats_today.clear()
 
 
 def insert_click_offer(
@@ -627,34 +811,25 @@ def insert_click_offer(
     photo_plaque_path: str | None = None,
     audio_path: str | None = None,
 ):
-    exec_sql(
-        """
-        INSERT INTO breaker_click_offers(
-          breaker_id, code_moteur, marque, energie, type_nom, type_modele, type_annee,
-          prix_demande, qty, note, immatriculation, vin, photo_moteur_path, photo_plaque_path, audio_path
-        ) VALUES(
-          :breaker_id, :code_moteur, :marque, :energie, :type_nom, :type_modele, :type_annee,
-          :prix_demande, :qty, :note, :immatriculation, :vin, :photo_moteur_path, :photo_plaque_path, :audio_path
-        )
-        """,
+    insert_click_offers_bulk([
         {
-            "breaker_id": int(breaker_id),
-            "code_moteur": (code_moteur or "").strip().upper(),
+            "breaker_id": breaker_id,
+            "code_moteur": code_moteur,
             "marque": marque,
             "energie": energie,
             "type_nom": type_nom,
             "type_modele": type_modele,
             "type_annee": type_annee,
             "prix_demande": prix_demande,
-            "qty": int(qty),
+            "qty": qty,
             "note": note,
             "immatriculation": immatriculation,
             "vin": vin,
             "photo_moteur_path": photo_moteur_path,
             "photo_plaque_path": photo_plaque_path,
             "audio_path": audio_path,
-        },
-    )
+        }
+    ])
 
 
 def insert_free_offer(
@@ -668,18 +843,10 @@ def insert_free_offer(
     photo_plaque_path: str | None = None,
     audio_path: str | None = None,
 ):
-    exec_sql(
-        """
-        INSERT INTO breaker_free_offers(
-          breaker_id, texte, prix_demande, note, immatriculation, vin, photo_moteur_path, photo_plaque_path, audio_path
-        )
-        VALUES(
-          :breaker_id, :texte, :prix_demande, :note, :immatriculation, :vin, :photo_moteur_path, :photo_plaque_path, :audio_path
-        )
-        """,
+    insert_free_offers_bulk([
         {
-            "breaker_id": int(breaker_id),
-            "texte": (texte or "").strip(),
+            "breaker_id": breaker_id,
+            "texte": texte,
             "prix_demande": prix_demande,
             "note": note,
             "immatriculation": immatriculation,
@@ -687,52 +854,41 @@ def insert_free_offer(
             "photo_moteur_path": photo_moteur_path,
             "photo_plaque_path": photo_plaque_path,
             "audio_path": audio_path,
-        },
-    )
+        }
+    ])
 
 
+# Listes "récentes" : colonnes de synthèse uniquement (pas de note / VIN / chemins
+# de fichiers), le détail complet est chargé à la demande via get_*_offer_details.
 @st.cache_data(show_spinner=False, ttl=120)
 def get_recent_click_offers(limit: int = 50) -> pd.DataFrame:
     q = """
     SELECT
+      o.id,
       o.created_at,
       b.name AS casse,
       o.code_moteur,
       o.marque,
       o.energie,
-      o.type_nom,
-      o.type_modele,
-      o.type_annee,
       o.prix_demande,
-      o.qty,
-      o.note,
-      o.immatriculation,
-      o.vin,
-      o.photo_moteur_path,
-      o.photo_plaque_path,
-      o.audio_path
+      o.qty
     FROM breaker_click_offers o
     JOIN breakers b ON b.id = o.breaker_id
     ORDER BY o.id DESC
     LIMIT :lim
     """
-    return sql_df(q, {"lim": int(limit)})
+    return sql_df(q, {"lim": int(limit)}, chunksize=10000)
 
 
 @st.cache_data(show_spinner=False, ttl=120)
 def get_recent_free_offers(limit: int = 50) -> pd.DataFrame:
     q = """
     SELECT
+      o.id,
       o.created_at,
       b.name AS casse,
       o.texte,
-      o.prix_demande,
-      o.note,
-      o.immatriculation,
-      o.vin,
-      o.photo_moteur_path,
-      o.photo_plaque_path,
-      o.audio_path
+      o.prix_demande
     FROM breaker_free_offers o
     JOIN breakers b ON b.id = o.breaker_id
     ORDER BY o.id DESC
@@ -741,16 +897,44 @@ def get_recent_free_offers(limit: int = 50) -> pd.DataFrame:
     return sql_df(q, {"lim": int(limit)})
 
 
+@st.cache_data(show_spinner=False, ttl=120)
+def get_click_offer_details(offer_id: int) -> pd.DataFrame:
+    q = """
+    SELECT b.name AS casse, o.*
+    FROM breaker_click_offers o
+    JOIN breakers b ON b.id = o.breaker_id
+    WHERE o.id = :id
+    """
+    return sql_df(q, {"id": int(offer_id)})
+
+
+@st.cache_data(show_spinner=False, ttl=120)
+def get_free_offer_details(offer_id: int) -> pd.DataFrame:
+    q = """
+    SELECT b.name AS casse, o.*
+    FROM breaker_free_offers o
+    JOIN breakers b ON b.id = o.breaker_id
+    WHERE o.id = :id
+    """
+    return sql_df(q, {"id": int(offer_id)})
+
+
 @st.cache_data(show_spinner=False, ttl=60)
 def get_breaker_stats_today(breaker_id: int) -> dict:
+    # Bornes sur created_at (et non created_at::date) pour rester sargable
     q = """
     SELECT
-      (SELECT COUNT(*) FROM breaker_click_offers
-        WHERE breaker_id = :bid AND created_at::date = CURRENT_DATE) AS n_click,
-      (SELECT COUNT(*) FROM breaker_free_offers
-        WHERE breaker_id = :bid AND created_at::date = CURRENT_DATE) AS n_free
+      COUNT(*) FILTER (WHERE src = 'click') AS n_click,
+      COUNT(*) FILTER (WHERE src = 'free')  AS n_free
+    FROM (
+      SELECT 'click' AS src FROM breaker_click_offers
+        WHERE breaker_id = :bid AND created_at >= CURRENT_DATE AND created_at < CURRENT_DATE + 1
+      UNION ALL
+      SELECT 'free' FROM breaker_free_offers
+        WHERE breaker_id = :bid AND created_at >= CURRENT_DATE AND created_at < CURRENT_DATE + 1
+    ) t
     """
-    row = sql_df(q, {"bid": int(breaker_id)}).iloc[0].to_dict()
+    row = fetch_one(q, {"bid": int(breaker_id)})
     return {"click": int(row["n_click"]), "free": int(row["n_free"]), "total": int(row["n_click"]) + int(row["n_free"])}
 
 # ========================================
@@ -765,7 +949,7 @@ def get_breaker_stats_today(breaker_id: int) -> dict:
 # =========================
 
 @st.cache_data(show_spinner=False, ttl=300)
-def search_plaque(plaque: str) -> pd.DataFrame:
+def search_plaque(plaque: str) -> dict | None:
     """
     Recherche une plaque dans la base et retourne les infos du véhicule.
     
@@ -783,10 +967,10 @@ def search_plaque(plaque: str) -> pd.DataFrame:
         plaque: Numéro de plaque d'immatriculation (format libre)
     
     Returns:
-        DataFrame avec les infos du véhicule (vide si non trouvé)
+        Dict avec les infos du véhicule (None si non trouvé)
     """
     if not plaque or not plaque.strip():
-        return pd.DataFrame()
+        return None
     
     # Normaliser la plaque (enlever espaces, tirets, majuscules)
     plaque_norm = plaque.upper().replace(" ", "").replace("-", "")
@@ -800,115 +984,168 @@ def search_plaque(plaque: str) -> pd.DataFrame:
         annee,
         energie
     FROM public.plaques_vehicules
+    -- Même expression que idx_plaques_norm (ensure_indexes) pour un index seek
     WHERE REPLACE(REPLACE(UPPER(plaque), ' ', ''), '-', '') = :plaque
     LIMIT 1
     """
-    return sql_df(q, {"plaque": plaque_norm})
+    return fetch_one(q, {"plaque": plaque_norm})
 
 
-def filter_besoins_by_plaque(besoins: pd.DataFrame, plaque_info: dict) -> pd.DataFrame:
+def get_besoins_by_plaque(top_n: int, plaque_info: dict) -> pd.DataFrame:
     """
-    Filtre les besoins en fonction des informations de la plaque.
+    Récupère les besoins correspondant aux informations de la plaque.
     
-    Logique de filtrage :
+    Logique de filtrage (poussée dans la requête SQL) :
     1. D'abord, cherche par code moteur EXACT
        → Si trouvé, retourne uniquement ces besoins
     2. Sinon, cherche par marque ET énergie
        → Retourne les besoins qui correspondent
-    3. Si rien ne correspond, retourne tous les besoins
+    3. Si rien ne correspond, retourne tous les besoins (top N)
     
     Args:
-        besoins: DataFrame des besoins actuels
+        top_n: Nombre maximum de besoins retournés
         plaque_info: Dict avec les infos du véhicule
                     (code_moteur, marque, energie, etc.)
     
     Returns:
-        DataFrame filtré des besoins
+        DataFrame des besoins
         
     Examples:
         >>> plaque_info = {"code_moteur": "K9K", "marque": "RENAULT", "energie": "DIESEL"}
-        >>> besoins_filtres = filter_besoins_by_plaque(besoins, plaque_info)
+        >>> besoins = get_besoins_by_plaque(50, plaque_info)
         # Retourne uniquement les besoins K9K
     """
-    if besoins.empty or not plaque_info:
-        return besoins
+    if not plaque_info:
+        return get_besoins_moteurs(top_n)
     
-    # 1️⃣ Recherche par code moteur exact (priorité)
-    code = plaque_info.get("code_moteur", "").upper()
-    if code:
-        exact_match = besoins[besoins["code_moteur"].str.upper() == code]
+    # 1️⃣ Recherche par code moteur exact (priorité) — code_moteur est en majuscules (SQL)
+    code = (plaque_info.get("code_moteur") or "").strip().upper()
+    # Sonde d'existence avant la requête complète : code absent des besoins → palier suivant
+    if code and has_besoin_for_code(code):
+        exact_match = get_besoins_moteurs_filtered(top_n, code_moteur=code)
         if not exact_match.empty:
             return exact_match
     
     # 2️⃣ Sinon recherche par marque + energie
-    marque = plaque_info.get("marque", "").upper()
-    energie = plaque_info.get("energie", "").upper()
+    marque = (plaque_info.get("marque") or "").strip().upper()
+    energie = (plaque_info.get("energie") or "").strip().upper()
     
-    filtered = besoins.copy()
+    if marque or energie:
+        filtered = get_besoins_moteurs_filtered(top_n, marque=marque or None, energie=energie or None)
+        if not filtered.empty:
+            return filtered
     
-    if marque:
-        filtered = filtered[filtered["marque"].str.upper().str.contains(marque, na=False)]
-    
-    if energie:
-        filtered = filtered[filtered["energie"].str.upper().str.contains(energie, na=False)]
-    
-    # 3️⃣ Retourne les résultats filtrés ou tous les besoins si rien ne correspond
-    return filtered if not filtered.empty else besoins
+    # 3️⃣ Rien ne correspond : tous les besoins
+    return get_besoins_moteurs(top_n)
 # =========================
 # Matching
 # =========================
+_WS_RE = re.compile(r"\s+")
+_TRANS = str.maketrans({"-": " ", "_": " ", ".": " "})
+
+
+@lru_cache(maxsize=4096)
 def normalize_text(text: str) -> str:
     if not text:
         return ""
-    text = str(text).upper().strip()
-    text = text.replace("-", " ").replace("_", " ").replace(".", " ")
-    import re
-    text = re.sub(r"\s+", " ", text)
-    return text
+    return _WS_RE.sub(" ", str(text).upper().strip().translate(_TRANS))
+
+
+MOTOR_SYNONYMS = {
+    "RENAULT": ["REN", "RENO", "R"],
+    "PEUGEOT": ["PEU", "PSA", "P"],
+    "CITROEN": ["CIT", "CITRO", "C"],
+    "VOLKSWAGEN": ["VW", "VOLKS"],
+    "MERCEDES": ["MERC", "MB", "MERCEDES-BENZ"],
+    "BMW": ["BM"],
+    "AUDI": ["AUD"],
+    "FORD": ["F"],
+    "OPEL": ["OP"],
+    "FIAT": ["FIA"],
+    "DIESEL": ["GASOIL", "GAZOLE", "HDI", "DCI", "TDI", "CDI", "TDCI", "D"],
+    "ESSENCE": ["ESS", "E", "TSI", "TFSI", "TCE"],
+    "ELECTRIQUE": ["ELEC", "EV", "ELECTRIC"],
+    "HYBRIDE": ["HYB", "HYBRID"],
+    "TURBO": ["T", "TURB"],
+    "INJECTION": ["INJ", "I"],
+    "COMMON RAIL": ["CR", "COMMONRAIL"],
+    "BOITE": ["BV", "BA", "GEARBOX"],
+    "AUTOMATIQUE": ["AUTO", "AT", "BVA"],
+    "MANUELLE": ["MAN", "MT", "BVM"],
+}
 
 
-@st.cache_data(show_spinner=False, ttl=24 * 3600)
-def get_motor_synonyms() -> dict:
-    return {
-        "RENAULT": ["REN", "RENO", "R"],
-        "PEUGEOT": ["PEU", "PSA", "P"],
-        "CITROEN": ["CIT", "CITRO", "C"],
-        "VOLKSWAGEN": ["VW", "VOLKS"],
-        "MERCEDES": ["MERC", "MB", "MERCEDES-BENZ"],
-        "BMW": ["BM"],
-        "AUDI": ["AUD"],
-        "FORD": ["F"],
-        "OPEL": ["OP"],
-        "FIAT": ["FIA"],
-        "DIESEL": ["GASOIL", "GAZOLE", "HDI", "DCI", "TDI", "CDI", "TDCI", "D"],
-        "ESSENCE": ["ESS", "E", "TSI", "TFSI", "TCE"],
-        "ELECTRIQUE": ["ELEC", "EV", "ELECTRIC"],
-        "HYBRIDE": ["HYB", "HYBRID"],
-        "TURBO": ["T", "TURB"],
-        "INJECTION": ["INJ", "I"],
-        "COMMON RAIL": ["CR", "COMMONRAIL"],
-        "BOITE": ["BV", "BA", "GEARBOX"],
-        "AUTOMATIQUE": ["AUTO", "AT", "BVA"],
-        "MANUELLE": ["MAN", "MT", "BVM"],
-    }
+# Tables précalculées (formes normalisées) : synonyme -> forme canonique,
+# et forme canonique -> synonymes. Les entrées multi-mots ("COMMON RAIL",
+# "MERCEDES-BENZ") sont traitées à part par sous-chaîne bornée par des espaces.
+_SYN_BWD = {
+    normalize_text(k): tuple(normalize_text(v) for v in vs) for k, vs in MOTOR_SYNONYMS.items()
+}
+_SYN_FWD = {v: k for k, vs in _SYN_BWD.items() for v in vs}
+_SYN_FWD_WORD = {v: k for v, k in _SYN_FWD.items() if " " not in v}
+_SYN_FWD_PHRASE = {v: k for v, k in _SYN_FWD.items() if " " in v}
+_SYN_BWD_PHRASE = {k: vs for k, vs in _SYN_BWD.items() if " " in k}
+# Tous les mots simples qui déclenchent une variante (synonymes et formes canoniques)
+_ALL_TOKENS = frozenset(_SYN_FWD_WORD) | frozenset(k for k in _SYN_BWD if " " not in k)
 
 
-def create_search_variants(text: str) -> list:
-    if not text:
-        return []
-    synonyms = get_motor_synonyms()
-    variants = [normalize_text(text)]
-    norm = normalize_text(text)
+def _replace_phrase(norm: str, old: str, new: str) -> str:
+    return f" {norm} ".replace(f" {old} ", f" {new} ").strip()
 
-    for key, values in synonyms.items():
-        for value in values:
-            if value in norm:
-                variants.append(norm.replace(value, key))
-            if key in norm:
-                for v in values:
-                    variants.append(norm.replace(key, v))
 
-    return list(set(variants))
+@lru_cache(maxsize=1024)
+def create_search_variants(text: str) -> tuple[str, ...]:
+    if not text:
+        return ()
+    norm = normalize_text(text)
+    tokens = norm.split()
+    padded = f" {norm} "
+    variants = {norm}
+
+    # Mots simples : une seule intersection d'ensembles au lieu d'un test par synonyme.
+    # Synonyme -> canonique (une variante par synonyme présent) et canonique -> synonymes.
+    for tok in set(tokens) & _ALL_TOKENS:
+        if tok in _SYN_FWD_WORD:
+            variants.add(" ".join(_SYN_FWD_WORD[tok] if t == tok else t for t in tokens))
+        for v in _SYN_BWD.get(tok, ()):
+            if f" {v} " not in padded:
+                variants.add(_replace_phrase(norm, tok, v))
+    # + une variante où tous les synonymes sont remplacés en une passe
+    variants.add(" ".join(_SYN_FWD_WORD.get(t, t) for t in tokens))
+
+    # Entrées multi-mots, peu nombreuses : sous-chaîne bornée par des espaces
+    for phrase, key in _SYN_FWD_PHRASE.items():
+        if f" {phrase} " in padded:
+            variants.add(_replace_phrase(norm, phrase, key))
+    for key, values in _SYN_BWD_PHRASE.items():
+        if f" {key} " in padded:
+            for v in values:
+                if f" {v} " not in padded:
+                    variants.add(_replace_phrase(norm, key, v))
+
+    return tuple(variants)
+
+
+MOTOR_TEXT_COLS = ["code_moteur", "marque", "energie", "type_nom", "type_modele", "type_annee"]
+
+
+def _text_col(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series("", index=df.index, dtype=object)
+    s = df[col]
+    return s.astype(str).where(s.notna(), "")
+
+
+def build_motor_norm(df: pd.DataFrame) -> pd.Series:
+    """Texte normalisé (code + marque + énergie + type) sur lequel porte la recherche."""
+    parts = [_text_col(df, c) for c in MOTOR_TEXT_COLS]
+    return (
+        parts[0].str.cat(parts[1:], sep=" ")
+        .str.upper()
+        .str.strip()
+        .str.replace(r"[-_.]", " ", regex=True)
+        .str.replace(r"\s+", " ", regex=True)
+    )
 
 
 def smart_match_motor(search_text: str, besoins: pd.DataFrame) -> pd.DataFrame:
@@ -918,49 +1155,41 @@ def smart_match_motor(search_text: str, besoins: pd.DataFrame) -> pd.DataFrame:
     search_norm = normalize_text(search_text)
     search_variants = create_search_variants(search_text)
 
-    scores = []
-    for idx, row in besoins.iterrows():
-        score = 0
-
-        motor_text = " ".join(
-            [
-                str(row.get("code_moteur", "")),
-                str(row.get("marque", "")),
-                str(row.get("energie", "")),
-                str(row.get("type_nom", "")),
-                str(row.get("type_modele", "")),
-                str(row.get("type_annee", "")),
-            ]
+    # Précalculé au chargement par get_besoins_moteurs ; recalculé sinon
+    if "motor_norm" in besoins.columns:
+        motor_norm = besoins["motor_norm"]
+    else:
+        motor_norm = build_motor_norm(besoins)
+
+    score = motor_norm.str.contains(search_norm, regex=False).astype(int) * 100
+
+    for variant in search_variants:
+        if variant:
+            score += motor_norm.str.contains(variant, regex=False).astype(int) * 50
+
+    # +10 par couple (mot cherché, mot moteur) dont l'un contient l'autre :
+    # calculé une fois par mot distinct, puis ramené à chaque ligne.
+    search_words = [w for w in search_norm.split() if len(w) >= 2]
+    if search_words:
+        motor_words = motor_norm.str.split().explode().dropna()
+        word_points = {
+            mword: 10 * sum(1 for sword in search_words if sword in mword or mword in sword)
+            for mword in pd.unique(motor_words)
+        }
+        score += (
+            motor_words.map(word_points)
+            .groupby(level=0)
+            .sum()
+            .reindex(besoins.index, fill_value=0)
+            .astype(int)
         )
-        motor_norm = normalize_text(motor_text)
-
-        if search_norm in motor_norm:
-            score += 100
-
-        for variant in search_variants:
-            if variant and variant in motor_norm:
-                score += 50
-
-        search_words = search_norm.split()
-        motor_words = motor_norm.split()
 
-        for sword in search_words:
-            if len(sword) >= 2:
-                for mword in motor_words:
-                    if sword in mword or mword in sword:
-                        score += 10
+    code_upper = _text_col(besoins, "code_moteur").str.upper()
+    score += code_upper.str.contains(search_norm, regex=False).astype(int) * 200
 
-        if search_norm in str(row.get("code_moteur", "")).upper():
-            score += 200
-
-        scores.append((idx, score))
-
-    scored = [(idx, score) for idx, score in scores if score > 0]
-    scored.sort(key=lambda x: x[1], reverse=True)
-
-    if scored:
-        matched_indices = [idx for idx, _ in scored]
-        return besoins.loc[matched_indices].copy()
+    score = score[score > 0].sort_values(ascending=False, kind="stable")
+    if not score.empty:
+        return besoins.loc[score.index].copy()
 
     return pd.DataFrame()
 
@@ -1041,28 +1270,72 @@ def render_home():
         md_html("<div style='text-align: center; margin-top: 1rem;'><h3>Mise à jour des prix</h3><p style='color: #6b7280;'>Propositions achat</p></div>")
 
 
+def run_parallel(tasks: dict, max_workers: int = 4) -> dict:
+    """
+    Lance des getters indépendants en parallèle (threads : attente réseau, le
+    GIL est relâché) et retourne {nom: résultat}. Chaque appel garde son
+    @st.cache_data ; le contexte Streamlit est propagé aux threads.
+    """
+    ctx = get_script_run_ctx()
+
+    def _call(fn):
+        add_script_run_ctx(ctx=ctx)
+        return fn()
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks)) or 1) as pool:
+        futures = {name: pool.submit(_call, fn) for name, fn in tasks.items()}
+        return {name: f.result() for name, f in futures.items()}
+
+
 # =========================
 # Queries (cache perf)
 # =========================
+def _cutoff(months: int):
+    # Borne calculée côté Python et calée sur le jour : paramètre stable sur la
+    # journée (plan réutilisable) au lieu de NOW() - INTERVAL évalué par requête.
+    return (pd.Timestamp.today().normalize() - pd.DateOffset(months=int(months))).date()
+
+
 @st.cache_data(show_spinner=False, ttl=120)
-def get_kpis_stock() -> dict:
+def get_all_kpis() -> dict[str, dict]:
+    """
+    KPIs stock moteurs + boîtes en un seul aller-retour.
+    Retourne {"moteurs": {dispo, vendus, total}, "boites": {...}}.
+    """
     q = """
-    SELECT
-      SUM(CASE WHEN est_disponible = 1 THEN 1 ELSE 0 END) AS dispo,
-      SUM(CASE WHEN est_disponible = 0 THEN 1 ELSE 0 END) AS vendus,
+    SELECT 'moteurs' AS source,
+      COUNT(*) FILTER (WHERE est_disponible = 1) AS dispo,
+      COUNT(*) FILTER (WHERE est_disponible = 0) AS vendus,
       COUNT(*) AS total
     FROM v_moteurs_dispo
+    UNION ALL
+    SELECT 'boites' AS source,
+      COUNT(*) FILTER (WHERE est_disponible = 1) AS dispo,
+      COUNT(*) FILTER (WHERE est_disponible = 0) AS vendus,
+      COUNT(*) AS total
+    FROM v_boites_dispo
     """
-    row = sql_df(q).iloc[0].to_dict()
-    return {k: int(row[k]) for k in row.keys()}
+    df = sql_df(q)
+    return {
+        src: {k: int(v) for k, v in kpis.items()}
+        for src, kpis in df.set_index("source").to_dict(orient="index").items()
+    }
+
+
+def _add_mois_from_jour(df: pd.DataFrame) -> pd.DataFrame:
+    # Le mois est dérivé du jour côté pandas (vectorisé) plutôt que par to_char
+    # par ligne côté PostgreSQL ; le GROUP BY ne porte plus que sur la date.
+    if "jour" in df.columns:
+        # Catégoriel : peu de mois distincts, les groupby travaillent sur des codes entiers
+        df.insert(1, "mois", pd.to_datetime(df["jour"]).dt.strftime("%Y-%m").astype("category"))
+    return df
 
 
 @st.cache_data(show_spinner=False, ttl=300)
 def get_ventes_recents(n_months: int) -> pd.DataFrame:
     q = """
     SELECT
-      em.date_validation::date AS jour,
-      to_char(em.date_validation, 'YYYY-MM') AS mois,
+      date_trunc('day', em.date_validation)::date AS jour,
       vd.type_nom AS code_moteur,
       vd.marque AS marque,
       vd.energie AS energie,
@@ -1075,27 +1348,74 @@ def get_ventes_recents(n_months: int) -> pd.DataFrame:
       ON vd.n_moteur = m.n_moteur
     left join tbl_types_moteurs tm 
       ON     m.n_type_moteur=tm.n_type_moteur 
-    WHERE em.date_validation >= NOW() - make_interval(months => :months)
+    WHERE em.date_validation >= :cutoff
         AND vd.type_nom IS NOT NULL
         AND TRIM(vd.type_nom) <> ''
-    GROUP BY jour, mois, vd.type_nom, vd.marque, vd.energie,LEFT(tm.nom_type_moteur, 3) 
+    GROUP BY 1, 2, 3, 4, 5
     """
-    return sql_df(q, {"months": int(n_months)})
+    df = _add_mois_from_jour(sql_df(q, {"cutoff": _cutoff(n_months)}, chunksize=10000))
+    return df.astype({"marque": "category", "energie": "category", "type_moteur": "category"})
 
 
 @st.cache_data(show_spinner=False, ttl=300)
 def get_ventes_recents_boites(n_months: int) -> pd.DataFrame:
     q = """
     SELECT
-      eb."date_validation"::date AS jour,
-      to_char(eb."date_validation", 'YYYY-MM') AS mois,
+      date_trunc('day', eb."date_validation")::date AS jour,
       eb."N_BV"::text AS code_boite,
       COUNT(*) AS nb_vendus
     FROM "tbl_EXPEDITIONS_boîtes" eb
-    WHERE eb."date_validation" >= NOW() - (:months || ' months')::interval
-    GROUP BY jour, mois, code_boite
+    WHERE eb."date_validation" >= :cutoff
+    GROUP BY 1, 2
+    """
+    return _add_mois_from_jour(sql_df(q, {"cutoff": _cutoff(n_months)}, dtypes={"code_boite": "category"}))
+
+
+# Top-K des graphiques de ventes calculés côté SQL : seules les K lignes
+# utiles remontent au lieu du détail jour x code x marque.
+@st.cache_data(show_spinner=False, ttl=300)
+def get_top_types_moteur_ventes(n_months: int, k: int = 20) -> pd.DataFrame:
+    q = """
+    SELECT
+      LEFT(tm.nom_type_moteur, 3) AS type_moteur,
+      COUNT(*) AS nb_vendus
+    FROM tbl_expeditions_moteurs em
+    JOIN tbl_moteurs m
+      ON m.n_moteur = em.n_moteur
+    LEFT JOIN v_moteurs_dispo vd
+      ON vd.n_moteur = m.n_moteur
+    LEFT JOIN tbl_types_moteurs tm
+      ON m.n_type_moteur = tm.n_type_moteur
+    WHERE em.date_validation >= :cutoff
+        AND vd.type_nom IS NOT NULL
+        AND TRIM(vd.type_nom) <> ''
+        AND tm.nom_type_moteur IS NOT NULL
+    GROUP BY 1
+    ORDER BY 2 DESC
+    LIMIT :k
+    """
+    return sql_df(q, {"cutoff": _cutoff(n_months), "k": int(k)})
+
+
+@st.cache_data(show_spinner=False, ttl=300)
+def get_top_marques_ventes(n_months: int, k: int = 15) -> pd.DataFrame:
+    q = """
+    SELECT
+      vd.marque AS marque,
+      COUNT(*) AS nb_vendus
+    FROM tbl_expeditions_moteurs em
+    JOIN v_moteurs_dispo vd
+      ON vd.n_moteur = em.n_moteur
+    WHERE em.date_validation >= :cutoff
+        AND vd.type_nom IS NOT NULL
+        AND TRIM(vd.type_nom) <> ''
+        AND vd.marque IS NOT NULL
+        AND vd.marque <> ''
+    GROUP BY 1
+    ORDER BY 2 DESC
+    LIMIT :k
     """
-    return sql_df(q, {"months": int(n_months)})
+    return sql_df(q, {"cutoff": _cutoff(n_months), "k": int(k)})
 
 
 def ensure_stock_views():
@@ -1111,231 +1431,398 @@ def ensure_stock_views():
     """)
 
 
+# Agrégat du stock disponible (code x marque x énergie), rafraîchi chaque nuit
+# par pg_cron (voir supabase_schema.sql) : évite de rescanner v_moteurs_dispo.
+# COALESCE sur les clés pour l'index unique requis par REFRESH ... CONCURRENTLY.
+MV_MOTEURS_DISPO_AGG_SQL = """
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_moteurs_dispo_agg AS
+SELECT
+  COALESCE(UPPER(code_moteur), '') AS code_moteur,
+  COALESCE(marque, '') AS marque,
+  COALESCE(energie, '') AS energie,
+  COUNT(*) AS n
+FROM v_moteurs_dispo
+WHERE est_disponible = 1
+  AND (archiver IS NULL OR archiver = True)
+GROUP BY 1, 2, 3;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_moteurs_dispo_agg
+  ON mv_moteurs_dispo_agg (code_moteur, marque, energie);
+"""
+
+
+def ensure_stock_agg():
+    exec_sql(MV_MOTEURS_DISPO_AGG_SQL)
+
+
+def ensure_indexes():
+    # Index d'expression : search_plaque filtre sur la plaque normalisée, sans
+    # cet index chaque recherche faisait un seq scan de plaques_vehicules.
+    # La table n'est pas créée par l'app, d'où le garde to_regclass.
+    exec_sql("""
+    DO $$
+    BEGIN
+      IF to_regclass('public.plaques_vehicules') IS NOT NULL THEN
+        CREATE INDEX IF NOT EXISTS idx_plaques_norm
+          ON public.plaques_vehicules ((REPLACE(REPLACE(UPPER(plaque), ' ', ''), '-', '')));
+      END IF;
+    END
+    $$;
+
+    -- UPPER(code_moteur) : filtre / clé de regroupement de la plupart des requêtes.
+    -- Index partiel : les requêtes qui s'en servent répètent son prédicat
+    -- (code_moteur IS NOT NULL AND TRIM(code_moteur) <> '').
+    CREATE INDEX IF NOT EXISTS idx_moteurs_code_upper ON tbl_moteurs (UPPER(code_moteur))
+      WHERE code_moteur IS NOT NULL AND TRIM(code_moteur) <> '';
+    -- Fenêtres de ventes : index couvrant sur la date (jointure + prix sans heap)
+    CREATE INDEX IF NOT EXISTS idx_exp_moteurs_date_cov ON tbl_expeditions_moteurs (date_validation)
+      INCLUDE (n_moteur, prix_vente_moteur);
+    """)
+
+
 # ========================================
 # VERSION ULTRA-SÉCURISÉE de get_besoins_moteurs()
 # Cette version ne plante pas même si les colonnes n'existent pas
 # REMPLACE ta fonction actuelle par celle-ci
 # ========================================
 
-@st.cache_data(show_spinner=False, ttl=300)
-def get_besoins_moteurs(top_n: int = 50) -> pd.DataFrame:
-    """
-    Récupère les besoins de moteurs - VERSION SÉCURISÉE
-    """
-    q = """
-    WITH ventes AS (
-        SELECT
-            UPPER(m.code_moteur) AS code_moteur,
-            m.n_type_moteur,
-            COUNT(*) AS nb_vendus_3m
-        FROM tbl_expeditions_moteurs em
-        JOIN tbl_moteurs m ON m.n_moteur = em.n_moteur
-        WHERE em.date_validation >= NOW() - INTERVAL '3 months'
-          AND m.code_moteur IS NOT NULL
-          AND TRIM(m.code_moteur) <> ''
-        GROUP BY UPPER(m.code_moteur), m.n_type_moteur
-    ),
-    achats AS (
-        SELECT
-            UPPER(m.code_moteur) AS code_moteur,
-            AVG(CASE WHEN r.date_achat >= NOW() - INTERVAL '3 months'  THEN m.prix_achat_moteur END) AS prix_moy_3m,
-            AVG(CASE WHEN r.date_achat >= NOW() - INTERVAL '6 months'  THEN m.prix_achat_moteur END) AS prix_moy_6m,
-            AVG(CASE WHEN r.date_achat >= NOW() - INTERVAL '12 months' THEN m.prix_achat_moteur END) AS prix_moy_12m
-        FROM tbl_moteurs m
-        JOIN tbl_receptions r ON r.n_reception = m.num_reception
-        WHERE m.prix_achat_moteur IS NOT NULL
-          AND r.date_achat IS NOT NULL
-        GROUP BY UPPER(m.code_moteur)
-    ),
-    stock_dispo AS (
-        SELECT
-            UPPER(code_moteur) AS code_moteur,
-            MAX(marque) AS marque,
-            MAX(energie) AS energie,
-            MAX(type_nom) AS type_nom,
-            MAX(type_modele) AS type_modele,
-            MAX(type_annee) AS type_annee,
-            COUNT(*) AS nb_stock_dispo
-        FROM v_moteurs_dispo
-        WHERE est_disponible = 1
-          AND (archiver IS NULL OR archiver = False)
-        GROUP BY UPPER(code_moteur)
-    )
+# Sous-requêtes inline plutôt que des CTE : le planner peut pousser les
+# prédicats, élaguer les colonnes et paralléliser chaque agrégat.
+# {where} : prédicat optionnel sur le résultat, appliqué avant le tri et le LIMIT.
+BESOINS_MOTEURS_SQL = """
+SELECT
+    v.code_moteur,
+    LEFT(COALESCE(s.type_nom, ''), 3) AS type_moteur,
+    COALESCE(s.marque, '') AS marque,          -- ✅ Depuis v_moteurs_dispo
+    COALESCE(s.energie, '') AS energie,        -- ✅ Depuis v_moteurs_dispo
+    COALESCE(s.type_nom, '') AS type_nom,      -- ✅ Depuis v_moteurs_dispo
+    COALESCE(s.type_modele, '') AS type_modele,-- ✅ Depuis v_moteurs_dispo
+    COALESCE(s.type_annee, '') AS type_annee,  -- ✅ Depuis v_moteurs_dispo
+    v.nb_vendus_3m,
+    COALESCE(s.nb_stock_dispo, 0) AS nb_stock_dispo,
+    v.nb_vendus_3m::float8 / (COALESCE(s.nb_stock_dispo, 0) + 1) AS score_urgence,
+    a.prix_moy_3m::float8  AS prix_moy_achat_3m,
+    a.prix_moy_6m::float8  AS prix_moy_achat_6m,
+    a.prix_moy_12m::float8 AS prix_moy_achat_12m
+FROM (
     SELECT
-        v.code_moteur,
-        LEFT(COALESCE(s.type_nom, ''), 3) AS type_moteur,
-        COALESCE(s.marque, '') AS marque,          -- ✅ Depuis v_moteurs_dispo
-        COALESCE(s.energie, '') AS energie,        -- ✅ Depuis v_moteurs_dispo
-        COALESCE(s.type_nom, '') AS type_nom,      -- ✅ Depuis v_moteurs_dispo
-        COALESCE(s.type_modele, '') AS type_modele,-- ✅ Depuis v_moteurs_dispo
-        COALESCE(s.type_annee, '') AS type_annee,  -- ✅ Depuis v_moteurs_dispo
-        v.nb_vendus_3m,
-        COALESCE(s.nb_stock_dispo, 0) AS nb_stock_dispo,
-        ROUND(a.prix_moy_3m, 2)  AS prix_moy_achat_3m,
-        ROUND(a.prix_moy_6m, 2)  AS prix_moy_achat_6m,
-        ROUND(a.prix_moy_12m, 2) AS prix_moy_achat_12m
-    FROM ventes v
-    LEFT JOIN achats a ON a.code_moteur = v.code_moteur
-    LEFT JOIN stock_dispo s ON s.code_moteur = v.code_moteur
-    ORDER BY v.nb_vendus_3m DESC
-    LIMIT :topn
+        UPPER(m.code_moteur) AS code_moteur,
+        m.n_type_moteur,
+        COUNT(*) AS nb_vendus_3m
+    FROM tbl_expeditions_moteurs em
+    JOIN tbl_moteurs m ON m.n_moteur = em.n_moteur
+    WHERE em.date_validation >= :c3
+      AND m.code_moteur IS NOT NULL
+      AND TRIM(m.code_moteur) <> ''
+    GROUP BY UPPER(m.code_moteur), m.n_type_moteur
+) v
+LEFT JOIN (
+    SELECT
+        UPPER(m.code_moteur) AS code_moteur,
+        AVG(m.prix_achat_moteur) FILTER (WHERE r.date_achat >= :c3) AS prix_moy_3m,
+        AVG(m.prix_achat_moteur) FILTER (WHERE r.date_achat >= :c6) AS prix_moy_6m,
+        AVG(m.prix_achat_moteur) AS prix_moy_12m
+    FROM tbl_moteurs m
+    JOIN tbl_receptions r ON r.n_reception = m.num_reception
+    WHERE m.prix_achat_moteur IS NOT NULL
+      AND r.date_achat >= :c12
+    GROUP BY UPPER(m.code_moteur)
+) a ON a.code_moteur = v.code_moteur
+LEFT JOIN (
+    SELECT
+        UPPER(code_moteur) AS code_moteur,
+        MAX(marque) AS marque,
+        MAX(energie) AS energie,
+        MAX(type_nom) AS type_nom,
+        MAX(type_modele) AS type_modele,
+        MAX(type_annee) AS type_annee,
+        COUNT(*) AS nb_stock_dispo
+    FROM v_moteurs_dispo
+    WHERE est_disponible = 1
+      AND (archiver IS NULL OR archiver = False)
+    GROUP BY UPPER(code_moteur)
+) s ON s.code_moteur = v.code_moteur
+{where}
+-- Top N par urgence (et non par ventes puis retri côté pandas)
+ORDER BY score_urgence DESC, v.nb_vendus_3m DESC
+LIMIT :topn OFFSET :offset
+"""
+
+
+def _besoins_params(top_n: int, offset: int = 0) -> dict:
+    return {"topn": int(top_n), "offset": int(offset), "c3": _cutoff(3), "c6": _cutoff(6), "c12": _cutoff(12)}
+
+
+def _fetch_besoins_moteurs(
+    top_n: int, where: str = "", params: dict | None = None, offset: int = 0
+) -> pd.DataFrame:
     """
-    df = sql_df(q, {"topn": int(top_n)})
+    Requête des besoins moteurs, avec un prédicat optionnel sur le résultat
+    (code_moteur / marque / energie) et un décalage pour la pagination.
+    """
+    df = sql_df(
+        BESOINS_MOTEURS_SQL.format(where=where),
+        {**_besoins_params(top_n, offset), **(params or {})},
+        dtypes={"code_moteur": "string[pyarrow]", "nb_vendus_3m": "int32", "nb_stock_dispo": "int32", "type_moteur": "category"},
+    )
     if not df.empty:
-        df["score_urgence"] = (df["nb_vendus_3m"] / (df["nb_stock_dispo"] + 1)).round(2)
-        df = df.sort_values(["score_urgence", "nb_vendus_3m"], ascending=False)
+        # Arrondis faits ici (vectorisé) plutôt que ROUND(::numeric) par ligne en SQL
+        rcols = ["score_urgence", "prix_moy_achat_3m", "prix_moy_achat_6m", "prix_moy_achat_12m"]
+        df[rcols] = df[rcols].round(2)
+        df["motor_norm"] = build_motor_norm(df)
+    return df
+
+
+@st.cache_data(show_spinner=False, ttl=300)
+def get_besoins_moteurs(top_n: int = 50) -> pd.DataFrame:
+    """
+    Récupère les besoins de moteurs - VERSION SÉCURISÉE
+    """
+    return _fetch_besoins_moteurs(top_n)
+
+
+@st.cache_data(show_spinner=False, ttl=300)
+def get_besoins_moteurs_page(top_n: int, page: int, page_size: int = 20) -> pd.DataFrame:
+    """
+    Une page du top N des besoins (LIMIT/OFFSET côté SQL) : seules les
+    lignes affichées remontent de Supabase.
+    """
+    offset = (max(1, int(page)) - 1) * int(page_size)
+    limit = min(int(page_size), int(top_n) - offset)
+    df = _fetch_besoins_moteurs(max(0, limit), offset=offset)
+    # Index global (rang dans le top N) : les clés des widgets restent propres à chaque moteur
+    df.index = pd.RangeIndex(offset, offset + len(df))
     return df
 
 
+@st.cache_data(show_spinner=False, ttl=300)
+def get_besoins_moteurs_summary(top_n: int) -> dict:
+    """
+    Compteurs du top N des besoins (nb, urgents, prix moyen) pour les
+    métriques et la pagination, sans charger les lignes.
+    """
+    q = f"""
+    SELECT
+      COUNT(*) AS nb,
+      COUNT(*) FILTER (WHERE ROUND(t.score_urgence::numeric, 2) > 5) AS nb_urgents,
+      AVG(ROUND(t.prix_moy_achat_3m::numeric, 2))::float8 AS prix_moyen
+    FROM ({BESOINS_MOTEURS_SQL.format(where="")}) t
+    """
+    return fetch_one(q, _besoins_params(top_n)) or {"nb": 0, "nb_urgents": 0, "prix_moyen": None}
+
+
+@st.cache_data(show_spinner=False, ttl=300)
+def has_besoin_for_code(code_moteur: str) -> bool:
+    """
+    Sonde d'existence (1 ligne, index partiel idx_moteurs_code_upper, dont
+    le prédicat est repris dans la requête) : le code
+    a-t-il des ventes sur 3 mois, donc une ligne dans les besoins ?
+    """
+    q = """
+    SELECT 1 AS ok
+    FROM tbl_moteurs m
+    JOIN tbl_expeditions_moteurs em ON em.n_moteur = m.n_moteur
+    WHERE UPPER(m.code_moteur) = :code
+      AND m.code_moteur IS NOT NULL
+      AND TRIM(m.code_moteur) <> ''
+      AND em.date_validation >= :c3
+    LIMIT 1
+    """
+    return fetch_one(q, {"code": code_moteur, "c3": _cutoff(3)}) is not None
+
+
+@st.cache_data(show_spinner=False, ttl=300)
+def get_besoins_moteurs_filtered(
+    top_n: int,
+    code_moteur: str | None = None,
+    marque: str | None = None,
+    energie: str | None = None,
+) -> pd.DataFrame:
+    """
+    Besoins moteurs filtrés côté SQL (valeurs attendues en majuscules) :
+    seules les lignes correspondantes remontent de Supabase.
+    """
+    conds, params = [], {}
+    if code_moteur:
+        conds.append("v.code_moteur = :code_moteur")
+        params["code_moteur"] = code_moteur
+    if marque:
+        conds.append("UPPER(TRIM(s.marque)) = :marque")
+        params["marque"] = marque
+    if energie:
+        conds.append("UPPER(TRIM(s.energie)) = :energie")
+        params["energie"] = energie
+    where = ("WHERE " + " AND ".join(conds)) if conds else ""
+    return _fetch_besoins_moteurs(top_n, where, params)
+
+
 @st.cache_data(show_spinner=False, ttl=300)
 def get_prix_vente_moy_code_3m() -> pd.DataFrame:
     q = """
     SELECT
       UPPER(m.code_moteur) AS code_moteur,
-      AVG(em.prix_vente_moteur) AS prix_vente_moy_3m,
+      AVG(em.prix_vente_moteur)::float8 AS prix_vente_moy_3m,
       COUNT(*) AS nb_ventes_3m
     FROM tbl_EXPEDITIONS_moteurs em
     JOIN tbl_MOTEURS m ON m.n_moteur = em.n_moteur
-    WHERE em.date_validation >= NOW() - INTERVAL '3 months'
+    WHERE em.date_validation >= :cutoff
       AND em.prix_vente_moteur IS NOT NULL
       AND em.prix_vente_moteur > 0
       AND m.code_moteur IS NOT NULL
       AND TRIM(m.code_moteur) <> ''
     GROUP BY UPPER(m.code_moteur)
     """
-    return sql_df(q)
-
-
-@st.cache_data(show_spinner=False, ttl=300)
-def get_stock_dispo_par_code() -> pd.DataFrame:
-    q = """
-    SELECT
-      UPPER(code_moteur) AS code_moteur,
-      COUNT(*) AS nb_stock_dispo
-    FROM v_moteurs_dispo
-    WHERE est_disponible = 1
-      AND (archiver IS NULL OR archiver = True)
-      AND code_moteur IS NOT NULL
-      AND TRIM(code_moteur) <> ''
-    GROUP BY UPPER(code_moteur)
-    """
-    return sql_df(q)
+    # code_moteur en chaîne Arrow, comme les clés du catalogue (load_catalog) : jointures sans conversion
+    return sql_df(
+        q,
+        {"cutoff": _cutoff(3)},
+        dtypes={"code_moteur": "string[pyarrow]", "nb_ventes_3m": "int32"},
+    )
 
 
 @st.cache_data(show_spinner=False, ttl=300)
 def get_stock_dispo_breakdown() -> pd.DataFrame:
+    # La vue stocke NULL sous forme de '' (clé de l'index unique) : on rend NULL
+    # comme l'ancienne lecture de v_moteurs_dispo. '' et NULL d'origine sont
+    # fusionnés, la page les écarte de toute façon tous les deux.
     return sql_df(
         """
-        SELECT marque, energie, COUNT(*) as n
-        FROM v_moteurs_dispo
-        WHERE est_disponible = 1
-          AND (archiver IS NULL OR archiver = True)
-        GROUP BY marque, energie
-        """
+        SELECT NULLIF(marque, '') AS marque, NULLIF(energie, '') AS energie, SUM(n) as n
+        FROM mv_moteurs_dispo_agg
+        GROUP BY 1, 2
+        """,
+        dtypes={"n": "int32", "marque": "category", "energie": "category"},
     )
 
 
-@st.cache_data(show_spinner=False, ttl=120)
-def get_kpis_from_view(view_name: str) -> dict:
-    q = f"""
-    SELECT
-      SUM(CASE WHEN est_disponible = 1 THEN 1 ELSE 0 END) AS dispo,
-      SUM(CASE WHEN est_disponible = 0 THEN 1 ELSE 0 END) AS vendus,
-      COUNT(*) AS total
-    FROM {view_name}
+@st.cache_data(show_spinner=False, ttl=300)
+def get_prix_achat_dispo(limit: int = 200000) -> np.ndarray:
+    # Une seule colonne numérique : tableau numpy direct, sans DataFrame.
+    # Cast float8 côté SQL pour ne pas matérialiser des Decimal Python.
+    q = """
+    SELECT prix_achat_moteur::float8
+    FROM v_moteurs_dispo
+    WHERE est_disponible = 1
+      AND prix_achat_moteur IS NOT NULL
+      AND prix_achat_moteur > 0
+    LIMIT :lim
     """
-    row = sql_df(q).iloc[0].to_dict()
-    return {k: int(row[k]) for k in row.keys()}
-
-
-def get_kpis_boites() -> dict:
-    return get_kpis_from_view("v_boites_dispo")
+    # stream_results : psycopg2 ouvre un curseur serveur nommé, et max_row_buffer
+    # borne le buffer côté client. Les paquets lus ont la même taille que ce
+    # buffer, copiés dans un tableau préalloué.
+    # float32 suffit pour un histogramme (moitié moins de mémoire).
+    lim = int(limit)
+    chunk = 10000
+    buf = np.empty(lim, dtype=np.float32)
+    n = 0
+    eng = get_engine()
+    with eng.connect().execution_options(stream_results=True, max_row_buffer=chunk) as conn:
+        res = conn.execute(sqltext(q), {"lim": lim})
+        for part in res.scalars().partitions(chunk):
+            buf[n:n + len(part)] = part
+            n += len(part)
+    return buf[:n].copy()
 
 
-@st.cache_data(show_spinner=False, ttl=300)
-def get_prix_achat_dispo(limit: int = 200000) -> pd.DataFrame:
-    return sql_df(
-        f"""
-        SELECT prix_achat_moteur AS prix
-        FROM v_moteurs_dispo
-        WHERE est_disponible = 1
-          AND prix_achat_moteur IS NOT NULL
-          AND prix_achat_moteur > 0
-        LIMIT {int(limit)}
-        """
-    )
 
 
 
+def _mois_from_dt(df: pd.DataFrame) -> pd.DataFrame:
+    # Tri fait en SQL sur la date tronquée (pas sur du texte) ; le libellé
+    # 'YYYY-MM' attendu par les graphes est formaté ici, en vectorisé.
+    if "mois_dt" in df.columns:
+        pos = df.columns.get_loc("mois_dt")
+        df.insert(pos, "mois", pd.to_datetime(df.pop("mois_dt")).dt.strftime("%Y-%m"))
+    return df
 
 
 @st.cache_data(show_spinner=False, ttl=300)
 def get_prix_achat_par_mois(n_months: int) -> pd.DataFrame:
     q = """
     SELECT
-      to_char(r."date_achat", 'YYYY-MM') AS mois,
+      date_trunc('month', r."date_achat") AS mois_dt,
       AVG(m."prix_achat_moteur") AS prix_achat_moy
     FROM tbl_MOTEURS m
     JOIN tbl_RECEPTIONS r ON r."n_reception" = m."num_reception"
-    WHERE r."date_achat" >= NOW() - (:months || ' months')::interval
+    WHERE r."date_achat" >= :cutoff
       AND m."prix_achat_moteur" IS NOT NULL
       AND m."prix_achat_moteur" > 0
-    GROUP BY mois
-    ORDER BY mois;
+    GROUP BY mois_dt
+    ORDER BY mois_dt;
     """
-    return sql_df(q, {"months": int(n_months)})
+    return _mois_from_dt(sql_df(q, {"cutoff": _cutoff(n_months)}))
 
 
 @st.cache_data(show_spinner=False, ttl=300)
 def get_prix_vente_par_mois(n_months: int) -> pd.DataFrame:
     q = """
     SELECT
-      to_char(em."date_validation", 'YYYY-MM') AS mois,
+      date_trunc('month', em."date_validation") AS mois_dt,
       AVG(em."prix_vente_moteur") AS prix_vente_moy
     FROM tbl_EXPEDITIONS_moteurs em
-    WHERE em."date_validation" >= NOW() - (:months || ' months')::interval
+    WHERE em."date_validation" >= :cutoff
       AND em."prix_vente_moteur" IS NOT NULL
       AND em."prix_vente_moteur" > 0
-    GROUP BY mois
-    ORDER BY mois;
+    GROUP BY mois_dt
+    ORDER BY mois_dt;
     """
-    return sql_df(q, {"months": int(n_months)})
+    return _mois_from_dt(sql_df(q, {"cutoff": _cutoff(n_months)}))
 
 
+# Séries mensuelles par code : une seule requête pour tout un lot de codes
+# (mis en cache par tuple), les accès code par code filtrent ce résultat.
 @st.cache_data(show_spinner=False, ttl=300)
-def get_prix_achat_par_mois_code(n_months: int, code: str) -> pd.DataFrame:
+def get_prix_achat_par_mois_codes(n_months: int, codes: tuple[str, ...]) -> pd.DataFrame:
     q = """
     SELECT
-      to_char(r."date_achat", 'YYYY-MM') AS mois,
+      UPPER(m."code_moteur") AS code_moteur,
+      date_trunc('month', r."date_achat") AS mois_dt,
       AVG(m."prix_achat_moteur") AS prix_achat_moy
     FROM tbl_MOTEURS m
     JOIN tbl_RECEPTIONS r ON r."n_reception" = m."num_reception"
-    WHERE r."date_achat" >= NOW() - (:months || ' months')::interval
-      AND UPPER(m."code_moteur") = :code
+    WHERE r."date_achat" >= :cutoff
+      AND UPPER(m."code_moteur") = ANY(:codes)
+      AND m."code_moteur" IS NOT NULL AND TRIM(m."code_moteur") <> ''  -- prédicat de idx_moteurs_code_upper
       AND m."prix_achat_moteur" IS NOT NULL
       AND m."prix_achat_moteur" > 0
-    GROUP BY mois
-    ORDER BY mois;
+    GROUP BY 1, 2
+    ORDER BY 1, 2;
     """
-    return sql_df(q, {"months": int(n_months), "code": code.upper()})
+    # psycopg2 adapte une list en ARRAY (un tuple deviendrait un record)
+    return _mois_from_dt(sql_df(q, {"cutoff": _cutoff(n_months), "codes": [c.upper() for c in codes]}))
 
 
 @st.cache_data(show_spinner=False, ttl=300)
-def get_prix_vente_par_mois_code(n_months: int, code: str) -> pd.DataFrame:
+def get_prix_vente_par_mois_codes(n_months: int, codes: tuple[str, ...]) -> pd.DataFrame:
     q = """
     SELECT
-      to_char(em."date_validation", 'YYYY-MM') AS mois,
+      UPPER(m."code_moteur") AS code_moteur,
+      date_trunc('month', em."date_validation") AS mois_dt,
       AVG(em."prix_vente_moteur") AS prix_vente_moy
     FROM tbl_EXPEDITIONS_moteurs em
     JOIN tbl_MOTEURS m ON m."n_moteur" = em."n_moteur"
-    WHERE em."date_validation" >= NOW() - (:months || ' months')::interval
-      AND UPPER(m."code_moteur") = :code
+    WHERE em."date_validation" >= :cutoff
+      AND UPPER(m."code_moteur") = ANY(:codes)
+      AND m."code_moteur" IS NOT NULL AND TRIM(m."code_moteur") <> ''  -- prédicat de idx_moteurs_code_upper
       AND em."prix_vente_moteur" IS NOT NULL
       AND em."prix_vente_moteur" > 0
-    GROUP BY mois
-    ORDER BY mois;
+    GROUP BY 1, 2
+    ORDER BY 1, 2;
     """
-    return sql_df(q, {"months": int(n_months), "code": code.upper()})
+    return _mois_from_dt(sql_df(q, {"cutoff": _cutoff(n_months), "codes": [c.upper() for c in codes]}))
+
+
+def _serie_code(df: pd.DataFrame, code: str) -> pd.DataFrame:
+    return df.loc[df["code_moteur"] == code.upper()].drop(columns="code_moteur").reset_index(drop=True)
+
+
+def get_prix_achat_par_mois_code(n_months: int, code: str, codes: tuple[str, ...] | None = None) -> pd.DataFrame:
+    # codes : lot préchargé contenant `code` (réutilise le cache du lot)
+    return _serie_code(get_prix_achat_par_mois_codes(n_months, codes or (code.upper(),)), code)
+
+
+def get_prix_vente_par_mois_code(n_months: int, code: str, codes: tuple[str, ...] | None = None) -> pd.DataFrame:
+    return _serie_code(get_prix_vente_par_mois_codes(n_months, codes or (code.upper(),)), code)
 
 
 @st.cache_data(show_spinner=False, ttl=300)
@@ -1345,91 +1832,94 @@ def get_price_movers(kind: str, window_months: int = 3, lookback_months: int = 1
 
     lb = int(lookback_months)
     w = int(window_months)
+    # Seules les 2 fenêtres (récente + précédente) comptent : inutile de lire
+    # au-delà de 2w mois, même si le lookback est plus long.
+    span = min(lb, 2 * w)
 
     if kind == "achat":
-        q = f"""
-        WITH base AS (
+        src = """
           SELECT
             UPPER(m."code_moteur") AS code_moteur,
             r."date_achat" AS dt,
             m."prix_achat_moteur" AS prix
           FROM tbl_MOTEURS m
           JOIN tbl_RECEPTIONS r ON r."n_reception" = m."num_reception"
-          WHERE r."date_achat" >= NOW() - INTERVAL '{lb} months'
+          WHERE r."date_achat" >= NOW() - make_interval(months => :span)
             AND m."prix_achat_moteur" IS NOT NULL
             AND m."prix_achat_moteur" > 0
-        ),
-        agg AS (
-          SELECT
-            code_moteur,
-            AVG(CASE WHEN dt >= NOW() - INTERVAL '{w} months' THEN prix END) AS avg_recent,
-            AVG(CASE WHEN dt <  NOW() - INTERVAL '{w} months'
-                      AND dt >= NOW() - INTERVAL '{w*2} months' THEN prix END) AS avg_prev,
-            SUM(CASE WHEN dt >= NOW() - INTERVAL '{w} months' THEN 1 ELSE 0 END) AS n_recent,
-            SUM(CASE WHEN dt <  NOW() - INTERVAL '{w} months'
-                      AND dt >= NOW() - INTERVAL '{w*2} months' THEN 1 ELSE 0 END) AS n_prev
-          FROM base
-          GROUP BY code_moteur
-        )
-        SELECT
-          code_moteur,
-          n_recent,
-          n_prev,
-          ROUND(avg_prev::numeric, 2) AS avg_prev,
-          ROUND(avg_recent::numeric, 2) AS avg_recent,
-          ROUND((avg_recent - avg_prev)::numeric, 2) AS delta,
-          CASE WHEN avg_prev IS NULL OR avg_prev = 0 THEN NULL
-               ELSE ROUND(((avg_recent - avg_prev) / avg_prev * 100.0)::numeric, 2)
-          END AS pct
-        FROM agg
-        WHERE n_recent >= :minc AND n_prev >= :minc
-          AND avg_recent IS NOT NULL AND avg_prev IS NOT NULL;
         """
     else:
-        q = f"""
-        WITH base AS (
+        src = """
           SELECT
             UPPER(m."code_moteur") AS code_moteur,
             em."date_validation" AS dt,
             em."prix_vente_moteur" AS prix
           FROM tbl_EXPEDITIONS_moteurs em
           JOIN tbl_MOTEURS m ON m."n_moteur" = em."n_moteur"
-          WHERE em."date_validation" >= NOW() - INTERVAL '{lb} months'
+          WHERE em."date_validation" >= NOW() - make_interval(months => :span)
             AND em."prix_vente_moteur" IS NOT NULL
             AND em."prix_vente_moteur" > 0
-        ),
-        agg AS (
-          SELECT
-            code_moteur,
-            AVG(CASE WHEN dt >= NOW() - INTERVAL '{w} months' THEN prix END) AS avg_recent,
-            AVG(CASE WHEN dt <  NOW() - INTERVAL '{w} months'
-                      AND dt >= NOW() - INTERVAL '{w*2} months' THEN prix END) AS avg_prev,
-            SUM(CASE WHEN dt >= NOW() - INTERVAL '{w} months' THEN 1 ELSE 0 END) AS n_recent,
-            SUM(CASE WHEN dt <  NOW() - INTERVAL '{w} months'
-                      AND dt >= NOW() - INTERVAL '{w*2} months' THEN 1 ELSE 0 END) AS n_prev
-          FROM base
-          GROUP BY code_moteur
-        )
-        SELECT
-          code_moteur,
-          n_recent,
-          n_prev,
-          ROUND(avg_prev::numeric, 2) AS avg_prev,
-          ROUND(avg_recent::numeric, 2) AS avg_recent,
-          ROUND((avg_recent - avg_prev)::numeric, 2) AS delta,
-          CASE WHEN avg_prev IS NULL OR avg_prev = 0 THEN NULL
-               ELSE ROUND(((avg_recent - avg_prev) / avg_prev * 100.0)::numeric, 2)
-          END AS pct
-        FROM agg
-        WHERE n_recent >= :minc AND n_prev >= :minc
-          AND avg_recent IS NOT NULL AND avg_prev IS NOT NULL;
         """
 
-    return sql_df(q, {"minc": int(min_count)})
+    # Une passe : chaque ligne reçoit son bucket (r = récent, p = précédent),
+    # puis agrégats FILTER au lieu des CASE répétés par fenêtre.
+    q = f"""
+    WITH base AS (
+      SELECT
+        code_moteur,
+        prix,
+        CASE WHEN dt >= NOW() - make_interval(months => :w) THEN 'r' ELSE 'p' END AS bucket
+      FROM ({src}) src
+    ),
+    agg AS (
+      SELECT
+        code_moteur,
+        AVG(prix) FILTER (WHERE bucket = 'r') AS avg_recent,
+        AVG(prix) FILTER (WHERE bucket = 'p') AS avg_prev,
+        COUNT(*)  FILTER (WHERE bucket = 'r') AS n_recent,
+        COUNT(*)  FILTER (WHERE bucket = 'p') AS n_prev
+      FROM base
+      GROUP BY code_moteur
+    )
+    SELECT
+      code_moteur,
+      n_recent,
+      n_prev,
+      avg_prev::float8 AS avg_prev,
+      avg_recent::float8 AS avg_recent,
+      (avg_recent - avg_prev)::float8 AS delta,
+      CASE WHEN avg_prev IS NULL OR avg_prev = 0 THEN NULL
+           ELSE ((avg_recent - avg_prev) / avg_prev * 100.0)::float8
+      END AS pct
+    FROM agg
+    WHERE n_recent >= :minc AND n_prev >= :minc
+      AND avg_recent IS NOT NULL AND avg_prev IS NOT NULL;
+    """
+
+    df = sql_df(q, {"span": span, "w": w, "minc": int(min_count)})
+    rcols = ["avg_prev", "avg_recent", "delta", "pct"]
+    df[rcols] = df[rcols].round(2)
+    return df
+
 
+_CODE_INFO_PATH = CACHE_DIR / "code_info.parquet"
+_CODE_INFO_MAX_AGE = 3600  # secondes
 
-@st.cache_data(show_spinner=False, ttl=600)
+
+# Données de référence : gardées en mémoire aussi longtemps que la copie Parquet
+@st.cache_data(show_spinner=False, ttl=_CODE_INFO_MAX_AGE)
 def get_code_info() -> pd.DataFrame:
+    """
+    Infos descriptives par code moteur, indexées (triées) par code_moteur.
+    Quasi statiques : copie Parquet locale réutilisée pendant 1h, y compris
+    entre redémarrages du process, avant de réinterroger v_moteurs_dispo.
+    """
+    try:
+        if time.time() - _CODE_INFO_PATH.stat().st_mtime < _CODE_INFO_MAX_AGE:
+            return pd.read_parquet(_CODE_INFO_PATH)
+    except (OSError, ValueError, ImportError):
+        pass
+
     q = """
     SELECT
       UPPER(code_moteur) AS code_moteur,
@@ -1443,12 +1933,46 @@ def get_code_info() -> pd.DataFrame:
       AND TRIM(code_moteur) <> ''
     GROUP BY UPPER(code_moteur)
     """
-    return sql_df(q)
+    df = sql_df(q).set_index("code_moteur").sort_index()
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(_CODE_INFO_PATH, compression="zstd")
+    except (OSError, ValueError, ImportError):
+        pass  # disque en lecture seule : on garde juste le cache mémoire
+    return df
+
+
+# Dictionnaires code -> valeur par colonne, construits une fois et partagés
+# (lecture seule) : un Series.map par colonne remplace le merge par rendu.
+@st.cache_resource(show_spinner=False, ttl=_CODE_INFO_MAX_AGE)
+def get_code_info_maps() -> dict[str, dict]:
+    info = get_code_info()
+    return {col: info[col].to_dict() for col in info.columns}
 
 
 # =========================
 # Pages avec Plotly
 # =========================
+# Figures mémoïsées sur leurs données (petits tableaux déjà agrégés) : un rerun
+# sans changement de données réutilise la figure au lieu de la reconstruire.
+# x / y passés en tuples de valeurs Python : un ndarray object serait haché sur
+# ses pointeurs (tobytes) et ne retomberait jamais sur la même clé.
+@st.cache_data(show_spinner=False, ttl=300, max_entries=64)
+def _line_figure(x: tuple, y: tuple, title: str, xaxis_title: str, yaxis_title: str, color: str) -> go.Figure:
+    fig = go.Figure(go.Scatter(x=x, y=y, mode="lines+markers", line=dict(color=color, width=3), marker=dict(size=8)))
+    fig.update_layout(title=title, xaxis_title=xaxis_title, yaxis_title=yaxis_title,
+                      template="plotly_white", hovermode="x unified")
+    return fig
+
+
+@st.cache_data(show_spinner=False, ttl=300, max_entries=64)
+def _bar_figure(x: tuple, y: tuple, title: str, xaxis_title: str, yaxis_title: str, color: str) -> go.Figure:
+    fig = go.Figure(go.Bar(x=x, y=y, marker_color=color))
+    fig.update_layout(title=title, xaxis_title=xaxis_title, yaxis_title=yaxis_title,
+                      template="plotly_white", showlegend=False)
+    return fig
+
+
 def piece_selector(key: str = "piece_type") -> str:
     if key not in st.session_state:
         st.session_state[key] = "moteurs"
@@ -1485,54 +2009,40 @@ def render_ventes():
         st.warning("Aucune vente sur la période.")
         return
 
-    ventes_mois = ventes.groupby("mois")["nb_vendus"].sum().reset_index()
-    fig1 = px.line(
-        ventes_mois,
-        x="mois",
-        y="nb_vendus",
-        title=f"Ventes par mois (sur {n_months} mois)",
-        labels={"mois": "Mois", "nb_vendus": "Nombre de ventes"},
-    )
-    fig1.update_traces(line_color=COLORS["primary"], line_width=3, marker=dict(size=8))
-    fig1.update_layout(template="plotly_white", hovermode="x unified")
+    # Frames déjà agrégés (quelques dizaines de lignes) : go + listes de valeurs,
+    # sans la préparation de DataFrame faite par plotly.express
+    ventes_mois = ventes.groupby("mois", observed=True)["nb_vendus"].sum()
+    fig1 = _line_figure(tuple(ventes_mois.index.tolist()), tuple(ventes_mois.tolist()),
+                        f"Ventes par mois (sur {n_months} mois)", "Mois", "Nombre de ventes", COLORS["primary"])
     st.plotly_chart(fig1, use_container_width=True)
 
     col1, col2 = st.columns(2)
 
     with col1:
-        top_codes = (
-            ventes
-            .groupby("type_moteur")["nb_vendus"]
-            .sum()
-            .sort_values(ascending=False)
-            .head(20)
-            .reset_index()
-        )
+        if piece == "moteurs":
+            top_codes = get_top_types_moteur_ventes(n_months, 20)
+            top_col, top_title, top_label = "type_moteur", "Top 20 types moteur vendus (3 caractères)", "Type moteur"
+        else:
+            # Les ventes boîtes n'ont qu'un code : agrégat direct sur le frame déjà chargé
+            top_codes = (
+                ventes
+                .groupby(code_col, observed=True)["nb_vendus"]
+                .sum()
+                .nlargest(20)
+                .reset_index()
+            )
+            top_col, top_title, top_label = code_col, "Top 20 boîtes vendues", "Code boîte"
 
-        fig2 = px.bar(
-            top_codes,
-            x="type_moteur",
-            y="nb_vendus",
-            title="Top 20 types moteur vendus (3 caractères)",
-            labels={"type_moteur": "Type moteur", "nb_vendus": "Nombre de ventes"},
-        )
-        fig2.update_traces(marker_color=COLORS["secondary"])
-        fig2.update_layout(template="plotly_white", showlegend=False)
-        st.plotly_chart(fig2, use_container_width=True)
+        if not top_codes.empty:
+            fig2 = _bar_figure(tuple(top_codes[top_col].tolist()), tuple(top_codes["nb_vendus"].tolist()),
+                               top_title, top_label, "Nombre de ventes", COLORS["secondary"])
+            st.plotly_chart(fig2, use_container_width=True)
     with col2:
-        if piece == "moteurs" and "marque" in ventes.columns:
-            marques = ventes[ventes["marque"].notna() & (ventes["marque"] != "")]
-            if not marques.empty:
-                top_marques = marques.groupby("marque")["nb_vendus"].sum().sort_values(ascending=False).head(15).reset_index()
-                fig3 = px.bar(
-                    top_marques,
-                    x="marque",
-                    y="nb_vendus",
-                    title="Top 15 marques vendues",
-                    labels={"marque": "Marque", "nb_vendus": "Nombre de ventes"},
-                )
-                fig3.update_traces(marker_color=COLORS["info"])
-                fig3.update_layout(template="plotly_white", showlegend=False)
+        if piece == "moteurs":
+            top_marques = get_top_marques_ventes(n_months, 15)
+            if not top_marques.empty:
+                fig3 = _bar_figure(tuple(top_marques["marque"].tolist()), tuple(top_marques["nb_vendus"].tolist()),
+                                   "Top 15 marques vendues", "Marque", "Nombre de ventes", COLORS["info"])
                 st.plotly_chart(fig3, use_container_width=True)
 
     with st.expander("📋 Voir le détail des ventes"):
@@ -1582,24 +2092,18 @@ def render_besoins():
 
     top_urgent = (
         besoins
-        .groupby(code_col, as_index=False)["score_urgence"]
+        .groupby(code_col, as_index=False, observed=True)["score_urgence"]
         .max()
-        .sort_values("score_urgence", ascending=False)
-        .head(topk)
+        .nlargest(topk, "score_urgence")
     )
 
-    fig = px.bar(
-        top_urgent,
-        x=code_col,
-        y="score_urgence",
-        title=f"Top {topk} besoins les plus urgents",
-        labels={code_col: "Type moteur" if piece == "moteurs" else "Code boîte",
-                "score_urgence": "Score d'urgence"},
-        color="score_urgence",
-        color_continuous_scale=["#10b981", "#f59e0b", "#ef4444"],
-    )
-    fig.update_layout(template="plotly_white", showlegend=False)
-    st.plotly_chart(fig, use_container_width=True)
+    # Couleur unie : les barres sont déjà triées par urgence, une échelle
+    # continue ajouterait une colorbar sans information supplémentaire
+    if not top_urgent.empty:
+        fig = _bar_figure(tuple(top_urgent[code_col].tolist()), tuple(top_urgent["score_urgence"].tolist()),
+                          f"Top {topk} besoins les plus urgents",
+                          "Type moteur" if piece == "moteurs" else "Code boîte", "Score d'urgence", COLORS["primary"])
+        st.plotly_chart(fig, use_container_width=True)
 
     base_cols = [code_col, "nb_vendus_3m", "nb_stock_dispo", "score_urgence"]
     optional_cols = ["marque", "energie", "type_nom", "type_modele", "type_annee"]
@@ -1608,6 +2112,15 @@ def render_besoins():
     st.dataframe(besoins[cols_to_show], use_container_width=True)
 
 
+def shift_casse_page(delta: int, pages: int):
+    st.session_state["casse_page"] = min(max(1, st.session_state.get("casse_page", 1) + delta), pages)
+
+
+def toggle_casse_card(idx):
+    key = f"modal_open_{idx}"
+    st.session_state[key] = not st.session_state.get(key, False)
+
+
 def render_casse():
     # ✅ (1) + ✅ (2) : éviter KeyError si refresh / session reset
     st.session_state.setdefault("breaker_ok", False)
@@ -1657,21 +2170,25 @@ def render_casse():
             saved_name = localstorage_get("breaker_name", "")
             saved_code = localstorage_get("breaker_code", "")
 
-            breaker_name = st.text_input(
-                "🏢 Nom de votre casse",
-                key="breaker_name",
-                value=saved_name,
-                placeholder="Ex: Casse Auto 32",
-            )
-            code = st.text_input(
-                "🔑 Code d'accès",
-                type="password",
-                key="breaker_code",
-                value=saved_code,
-                placeholder="Votre code",
-            )
+            # Formulaire : la saisie ne relance pas la page, seule la validation compte
+            with st.form("casse_login", clear_on_submit=False, border=False):
+                breaker_name = st.text_input(
+                    "🏢 Nom de votre casse",
+                    key="breaker_name",
+                    value=saved_name,
+                    placeholder="Ex: Casse Auto 32",
+                )
+                code = st.text_input(
+                    "🔑 Code d'accès",
+                    type="password",
+                    key="breaker_code",
+                    value=saved_code,
+                    placeholder="Votre code",
+                )
+
+                submitted = st.form_submit_button("✅ Accéder à l'interface", type="primary", use_container_width=True)
 
-            if st.button("✅ Accéder à l'interface", type="primary", use_container_width=True):
+            if submitted:
                 if hmac.compare_digest((code or "").strip(), access_code):
                     if not breaker_name.strip():
                         st.error("Veuillez entrer le nom de votre casse")
@@ -1755,24 +2272,28 @@ def render_casse():
     </div>
     """)
 
-    # Champ de saisie de la plaque
-    plaque_input = st.text_input(
-        "Numéro de plaque",
-        key="plaque_search",
-        placeholder="Ex: AB-123-CD ou AB123CD",
-        label_visibility="collapsed",
-    )
+    # Champ de saisie de la plaque, dans un formulaire : la recherche ne part
+    # qu'à la validation (Entrée ou 🔎), pas à chaque perte de focus
+    with st.form("plaque_form", clear_on_submit=False, border=False):
+        col_pl, col_pl_btn = st.columns([5, 1])
+        with col_pl:
+            plaque_input = st.text_input(
+                "Numéro de plaque",
+                key="plaque_search",
+                placeholder="Ex: AB-123-CD ou AB123CD",
+                label_visibility="collapsed",
+            )
+        with col_pl_btn:
+            st.form_submit_button("🔎", use_container_width=True)
 
     # Initialiser la variable plaque_data
     plaque_data = None
 
     # Si une plaque est saisie
     if plaque_input and plaque_input.strip():
-        plaque_df = search_plaque(plaque_input.strip())
-
-        if not plaque_df.empty:
-            plaque_data = plaque_df.iloc[0].to_dict()
+        plaque_data = search_plaque(plaque_input.strip())
 
+        if plaque_data:
             # Affichage visuel de la plaque style immatriculation française
             plaque_display = plaque_data.get("plaque", "").upper()
             md_html(f"""
@@ -1814,32 +2335,45 @@ def render_casse():
 
     col_search, col_nb = st.columns([3, 1])
     with col_search:
-        search = st.text_input(
-            "Rechercher",
-            key="casse_search",
-            placeholder="Ex: Renault diesel, K9K, Peugeot 1.6 HDI, Clio 2015...",
-            label_visibility="collapsed",
-        )
+        with st.form("search_form", clear_on_submit=False, border=False):
+            col_txt, col_btn = st.columns([5, 1])
+            with col_txt:
+                search = st.text_input(
+                    "Rechercher",
+                    key="casse_search",
+                    placeholder="Ex: Renault diesel, K9K, Peugeot 1.6 HDI, Clio 2015...",
+                    label_visibility="collapsed",
+                )
+            with col_btn:
+                st.form_submit_button("🔎", use_container_width=True)
     with col_nb:
         topn = st.selectbox("Moteurs", [20, 50, 100, 200], index=1, key="casse_topn", label_visibility="collapsed")
 
-    besoins = get_besoins_moteurs(topn)
+    # Sans plaque ni recherche texte, rien à filtrer côté pandas : on ne charge
+    # que la page affichée, les métriques viennent d'un agrégat SQL.
+    paged = not plaque_data and not (search and search.strip())
 
-    if besoins.empty:
-        st.info("Aucun besoin actuellement")
-        return
+    if paged:
+        summary = get_besoins_moteurs_summary(topn)
+        total = int(summary["nb"] or 0)
+        if total == 0:
+            st.info("Aucun besoin actuellement")
+            return
+        urgents = int(summary["nb_urgents"] or 0)
+        prix_moyen = summary["prix_moyen"]
+    else:
+        # Plaque active : le filtre est appliqué dans la requête, pas après coup en pandas
+        besoins = get_besoins_by_plaque(topn, plaque_data) if plaque_data else get_besoins_moteurs(topn)
 
-    if plaque_data:
-        besoins = filter_besoins_by_plaque(besoins, plaque_data)
         if besoins.empty:
-            st.warning(f"❌ Aucun besoin ne correspond au moteur {plaque_data.get('code_moteur', '')}")
-            st.info("💡 Ce moteur n'est pas recherché actuellement")
+            st.info("Aucun besoin actuellement")
             return
-        else:
+
+        if plaque_data:
             st.success(f"🎯 {len(besoins)} moteur(s) correspondant à la plaque !")
 
     # Filtrage par recherche texte (seulement si pas de plaque active)
-    if search and search.strip() and not plaque_data:  # ⬅️ AJOUTER "and not plaque_data"
+    if not paged and search and search.strip() and not plaque_data:  # ⬅️ AJOUTER "and not plaque_data"
         besoins_filtered = smart_match_motor(search.strip(), besoins)
 
         if besoins_filtered.empty:
@@ -1859,16 +2393,18 @@ def render_casse():
             besoins = besoins_filtered
             st.success(f"✅ {len(besoins)} moteur(s) trouvé(s) !")
 
-    if not besoins.empty:
-        col1, col2, col3 = st.columns(3)
-        with col1:
-            st.metric("Moteurs affichés", len(besoins))
-        with col2:
-            urgents = len(besoins[besoins["score_urgence"] > 5])
-            st.metric("🔥 Urgents", urgents)
-        with col3:
-            prix_moyen = besoins["prix_moy_achat_3m"].mean()
-            st.metric("💰 Prix moyen", f"{prix_moyen:.0f}€" if not pd.isna(prix_moyen) else "—")
+    if not paged:
+        total = len(besoins)
+        urgents = len(besoins[besoins["score_urgence"] > 5])
+        prix_moyen = besoins["prix_moy_achat_3m"].mean()
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Moteurs affichés", total)
+    with col2:
+        st.metric("🔥 Urgents", urgents)
+    with col3:
+        st.metric("💰 Prix moyen", f"{prix_moyen:.0f}€" if not pd.isna(prix_moyen) else "—")
 
     st.markdown("---")
 
@@ -1876,170 +2412,138 @@ def render_casse():
     if "casse_page" not in st.session_state:
         st.session_state["casse_page"] = 1
 
-    total = len(besoins)
     pages = max(1, (total + PAGE_SIZE - 1) // PAGE_SIZE)
+    # Top N réduit entre deux runs : on reste sur une page existante
+    st.session_state["casse_page"] = min(st.session_state["casse_page"], pages)
 
+    # Callbacks : la page change avant le rendu, sans second run via st.rerun()
     colp1, colp2, colp3 = st.columns([1, 2, 1])
     with colp1:
-        if st.button("⬅️", disabled=st.session_state["casse_page"] <= 1):
-            st.session_state["casse_page"] -= 1
-            st.rerun()
+        st.button("⬅️", disabled=st.session_state["casse_page"] <= 1,
+                  on_click=shift_casse_page, args=(-1, pages))
     with colp2:
         st.caption(f"Page {st.session_state['casse_page']} / {pages} • {total} moteurs")
     with colp3:
-        if st.button("➡️", disabled=st.session_state["casse_page"] >= pages):
-            st.session_state["casse_page"] += 1
-            st.rerun()
+        st.button("➡️", disabled=st.session_state["casse_page"] >= pages,
+                  on_click=shift_casse_page, args=(1, pages))
 
-    start = (st.session_state["casse_page"] - 1) * PAGE_SIZE
-    end = start + PAGE_SIZE
-    besoins = besoins.iloc[start:end].copy()
+    if paged:
+        besoins = get_besoins_moteurs_page(topn, st.session_state["casse_page"], PAGE_SIZE)
+    else:
+        start = (st.session_state["casse_page"] - 1) * PAGE_SIZE
+        end = start + PAGE_SIZE
+        besoins = besoins.iloc[start:end].copy()
 
     st.markdown("### 🎯 Moteurs recherchés (vue rapide)")
 
-    # ✅ AJOUT MINIMAL : normaliser l'affichage des champs (évite NaN qui rend tout "vide")
-    def clean_txt(v):
-        if v is None:
-            return "—"
-        try:
-            if pd.isna(v):
-                return "—"
-        except Exception:
-            pass
-        s = str(v).strip()
-        return s if s else "—"
-
-    for idx, row in besoins.iterrows():
+    # ✅ AJOUT MINIMAL : normaliser l'affichage des champs (évite NaN qui rend tout "vide").
+    # Une seule passe vectorisée sur la page : plus de pd.isna/pd.notna par ligne.
+    txt_cols = [c for c in ("code_moteur", "marque", "energie", "type_nom", "type_modele", "type_annee") if c in besoins.columns]
+    besoins = besoins.assign(
+        **{c: besoins[c].fillna("").astype(str).str.strip() for c in txt_cols},
+        score_urgence=pd.to_numeric(besoins["score_urgence"], errors="coerce").fillna(0.0),
+        prix_moy_achat_3m=pd.to_numeric(besoins["prix_moy_achat_3m"], errors="coerce").fillna(0.0),
+        nb_stock_dispo=besoins["nb_stock_dispo"].fillna(0).astype(int),
+        nb_vendus_3m=besoins["nb_vendus_3m"].fillna(0).astype(int),
+    )
+
+    # Niveau d'urgence calculé en une passe vectorisée pour toute la page
+    scores = besoins["score_urgence"].to_numpy(dtype=float)
+    urgence_conds = [scores > 5, scores > 2]
+    urgence_classes = np.select(urgence_conds, ["urg-high", "urg-mid"], "urg-ok")
+    urgence_labels = np.select(urgence_conds, ["🔥 TRÈS URGENT", "⚠️ URGENT"], "✓ Normal")
+
+    # Lignes en dicts (to_dict) plutôt qu'iterrows, qui construit une Series par ligne
+    rows = zip(besoins.index, besoins.to_dict("records"), urgence_classes, urgence_labels)
+    for idx, row, urgence_class, urgence_label in rows:
         code = row.get("code_moteur", "")
-        score = float(row.get("score_urgence", 0) or 0)
-        prix = row.get("prix_moy_achat_3m", None)
-        stock = int(row.get("nb_stock_dispo", 0) or 0)
-        vendus = int(row.get("nb_vendus_3m", 0) or 0)
+        score = row["score_urgence"]
+        prix = row["prix_moy_achat_3m"]
+        stock = row["nb_stock_dispo"]
+        vendus = row["nb_vendus_3m"]
 
-        marque = clean_txt(row.get("marque"))
-        energie = clean_txt(row.get("energie"))
-        type_nom = clean_txt(row.get("type_nom"))
-        type_modele = clean_txt(row.get("type_modele"))
-        type_annee = clean_txt(row.get("type_annee"))
+        marque = row.get("marque") or "—"
+        energie = row.get("energie") or "—"
+        type_nom = row.get("type_nom") or "—"
+        type_modele = row.get("type_modele") or "—"
+        type_annee = row.get("type_annee") or "—"
 
         desc_casse = suggest_motor_description(row)
 
-        if score > 5:
-            border_color, urgence_label, urgence_bg = "#dc2626", "🔥 TRÈS URGENT", "#fee2e2"
-        elif score > 2:
-            border_color, urgence_label, urgence_bg = "#d97706", "⚠️ URGENT", "#fef3c7"
-        else:
-            border_color, urgence_label, urgence_bg = "#059669", "✓ Normal", "#d1fae5"
-
-        # ✅ AJOUT DES INFOS MARQUE/ENERGIE ICI
+        # ✅ AJOUT DES INFOS MARQUE/ENERGIE ICI (styles dans inject_custom_css)
         md_html(f"""
-        <div style='background:white;border-left:6px solid {border_color};border-radius:14px;padding:14px;margin-bottom:12px;
-                    box-shadow:0 2px 10px rgba(0,0,0,0.08);'>
-        <div style='display:flex;justify-content:space-between;align-items:center;gap:12px;'>
-            <div style='display:flex;align-items:center;gap:10px;'>
-            <span style='font-family:monospace;font-weight:900;font-size:20px;
-                        background:linear-gradient(135deg,#667eea 0%,#764ba2 100%);
-                        color:white;padding:8px 12px;border-radius:10px;'>{code}</span>
-            <span style='background:{urgence_bg};color:{border_color};padding:6px 10px;border-radius:10px;
-                        font-weight:700;font-size:12px;'>{urgence_label}</span>
+        <div class='besoin-card {urgence_class}'>
+        <div class='besoin-head'>
+            <div class='besoin-id'>
+            <span class='besoin-code'>{code}</span>
+            <span class='besoin-badge'>{urgence_label}</span>
             </div>
-            <div style='text-align:right;'>
-            <div style='font-size:11px;color:#6b7280;font-weight:700;'>PRIX MOYEN</div>
-            <div style='font-size:18px;color:#111827;font-weight:900;'>{f"{int(prix):d}€" if pd.notna(prix) and float(prix) > 0 else "—"}</div>
+            <div class='besoin-price'>
+            <div class='besoin-price-label'>PRIX MOYEN</div>
+            <div class='besoin-price-value'>{f"{int(prix):d}€" if prix > 0 else "—"}</div>
             </div>
         </div>
-
-        <!-- ✅ SECTION AJOUTÉE : Affichage marque + energie + modèle -->
-        <div style='margin-top:10px;display:flex;gap:12px;flex-wrap:wrap;'>
-            <span style='background:#f3f4f6;padding:6px 12px;border-radius:8px;font-size:13px;font-weight:600;color:#374151;'>
-            🏭 {marque}
-            </span>
-            <span style='background:#fef3c7;padding:6px 12px;border-radius:8px;font-size:13px;font-weight:600;color:#92400e;'>
-            ⚡ {energie}
-            </span>
-            <span style='background:#e0e7ff;padding:6px 12px;border-radius:8px;font-size:13px;font-weight:600;color:#3730a3;'>
-            🚗 {type_modele}
-            </span>
-        </div>
-
-        <div style='margin-top:10px;background:#f9fafb;padding:10px;border-radius:10px;'>
-            <div style='color:#111827;font-weight:800;font-size:14px;'>🗣️ "{desc_casse}"</div>
+        <div class='besoin-tags'>
+            <span class='besoin-tag tag-marque'>🏭 {marque}</span>
+            <span class='besoin-tag tag-energie'>⚡ {energie}</span>
+            <span class='besoin-tag tag-modele'>🚗 {type_modele}</span>
         </div>
+        <div class='besoin-desc'>🗣️ "{desc_casse}"</div>
         </div>
         """)
 
-        if st.button("✅ Je l'ai", key=f"have_{idx}", type="primary", use_container_width=True):
-            st.session_state[f"modal_open_{idx}"] = True
-
-        with st.expander("Détails + proposer autre chose", expanded=bool(st.session_state.get(f"modal_open_{idx}", False))):
-            st.caption(f"📋 {marque} {energie} • {type_nom} {type_modele} {type_annee}".strip())
-            c1, c2, c3 = st.columns(3)
-            c1.metric("Vendus 3M", vendus)
-            c2.metric("En stock", stock)
-            c3.metric("Urgence", f"{score:.2f}")
-
-            st.divider()
-            st.subheader("✅ Envoyer mon offre")
-            col1, col2 = st.columns(2)
-            with col1:
-                prix_propose = st.number_input(
-                    "💰 Votre prix (€)",
-                    min_value=0.0,
-                    value=float(prix) if pd.notna(prix) and float(prix) > 0 else 100.0,
-                    step=10.0,
-                    key=f"prix_{idx}",
-                )
-                qty = st.number_input("📦 Quantité", min_value=1, value=1, key=f"qty_{idx}")
-            with col2:
-                note = st.text_area(
-                    "📝 Infos rapides",
-                    key=f"note_{idx}",
-                    placeholder="Ex: 120k km, bon état, dispo suite",
-                    height=90,
-                )
-
-            if st.button("📩 Envoyer", key=f"send_{idx}", type="primary", use_container_width=True):
-                insert_click_offer(
-                    breaker_id=breaker_id,
-                    code_moteur=code,
-                    marque=marque if pd.notna(marque) else None,
-                    energie=energie if pd.notna(energie) else None,
-                    type_nom=type_nom if pd.notna(type_nom) else None,
-                    type_modele=type_modele if pd.notna(type_modele) else None,
-                    type_annee=type_annee if pd.notna(type_annee) else None,
-                    prix_demande=float(prix_propose) if prix_propose > 0 else None,
-                    qty=int(qty),
-                    note=note.strip() if note.strip() else None,
-                    immatriculation=None,
-                    vin=None,
-                    photo_moteur_path=None,
-                    photo_plaque_path=None,
-                    audio_path=None,
-                )
-                st.session_state[f"modal_open_{idx}"] = False
-                st.success(f"✅ {code} enregistré !")
-                st.balloons()
-                st.rerun()
-
-            st.divider()
-            st.subheader("💬 Proposer une alternative")
-            alt_desc = st.text_input(
-                "Décrivez ce que vous avez",
-                key=f"alt_desc_{idx}",
-                placeholder=f"Ex: proche de {code}, autre année, autre version…",
-            )
-            alt_prix = st.number_input("Prix (€)", min_value=0.0, value=100.0, step=10.0, key=f"alt_prix_{idx}")
-            alt_note = st.text_input("Note", key=f"alt_note_{idx}", placeholder="Infos complémentaires")
+        col_have, col_det = st.columns([3, 1])
+        with col_have:
+            if st.button("✅ Je l'ai", key=f"have_{idx}", type="primary", use_container_width=True):
+                st.session_state[f"modal_open_{idx}"] = True
+        with col_det:
+            is_open = bool(st.session_state.get(f"modal_open_{idx}", False))
+            # Callback : la carte s'ouvre/se ferme dans le même run, sans st.rerun()
+            st.button("▲ Masquer" if is_open else "▼ Détails", key=f"toggle_{idx}", use_container_width=True,
+                      on_click=toggle_casse_card, args=(idx,))
+
+        # Formulaires d'offre construits seulement pour les cartes ouvertes :
+        # les cartes fermées n'envoient aucun widget au navigateur
+        if st.session_state.get(f"modal_open_{idx}", False):
+            with st.expander("Détails + proposer autre chose", expanded=True):
+                st.caption(f"📋 {marque} {energie} • {type_nom} {type_modele} {type_annee}".strip())
+                c1, c2, c3 = st.columns(3)
+                c1.metric("Vendus 3M", vendus)
+                c2.metric("En stock", stock)
+                c3.metric("Urgence", f"{score:.2f}")
+
+                st.divider()
+                st.subheader("✅ Envoyer mon offre")
+                col1, col2 = st.columns(2)
+                with col1:
+                    prix_propose = st.number_input(
+                        "💰 Votre prix (€)",
+                        min_value=0.0,
+                        value=float(prix) if prix > 0 else 100.0,
+                        step=10.0,
+                        key=f"prix_{idx}",
+                    )
+                    qty = st.number_input("📦 Quantité", min_value=1, value=1, key=f"qty_{idx}")
+                with col2:
+                    note = st.text_area(
+                        "📝 Infos rapides",
+                        key=f"note_{idx}",
+                        placeholder="Ex: 120k km, bon état, dispo suite",
+                        height=90,
+                    )
 
-            if st.button("📩 Envoyer alternative", key=f"send_alt_{idx}", use_container_width=True):
-                if not alt_desc.strip():
-                    st.error("Veuillez décrire votre proposition")
-                else:
-                    insert_free_offer(
+                if st.button("📩 Envoyer", key=f"send_{idx}", type="primary", use_container_width=True):
+                    insert_click_offer(
                         breaker_id=breaker_id,
-                        texte=f"Alternative pour {code}: {alt_desc}",
-                        prix_demande=float(alt_prix) if alt_prix > 0 else None,
-                        note=alt_note.strip() if alt_note.strip() else None,
+                        code_moteur=code,
+                        marque=marque,
+                        energie=energie,
+                        type_nom=type_nom,
+                        type_modele=type_modele,
+                        type_annee=type_annee,
+                        prix_demande=float(prix_propose) if prix_propose > 0 else None,
+                        qty=int(qty),
+                        note=note.strip() if note.strip() else None,
                         immatriculation=None,
                         vin=None,
                         photo_moteur_path=None,
@@ -2047,10 +2551,40 @@ def render_casse():
                         audio_path=None,
                     )
                     st.session_state[f"modal_open_{idx}"] = False
-                    st.success("✅ Proposition envoyée !")
+                    st.success(f"✅ {code} enregistré !")
                     st.balloons()
                     st.rerun()
 
+                st.divider()
+                st.subheader("💬 Proposer une alternative")
+                alt_desc = st.text_input(
+                    "Décrivez ce que vous avez",
+                    key=f"alt_desc_{idx}",
+                    placeholder=f"Ex: proche de {code}, autre année, autre version…",
+                )
+                alt_prix = st.number_input("Prix (€)", min_value=0.0, value=100.0, step=10.0, key=f"alt_prix_{idx}")
+                alt_note = st.text_input("Note", key=f"alt_note_{idx}", placeholder="Infos complémentaires")
+
+                if st.button("📩 Envoyer alternative", key=f"send_alt_{idx}", use_container_width=True):
+                    if not alt_desc.strip():
+                        st.error("Veuillez décrire votre proposition")
+                    else:
+                        insert_free_offer(
+                            breaker_id=breaker_id,
+                            texte=f"Alternative pour {code}: {alt_desc}",
+                            prix_demande=float(alt_prix) if alt_prix > 0 else None,
+                            note=alt_note.strip() if alt_note.strip() else None,
+                            immatriculation=None,
+                            vin=None,
+                            photo_moteur_path=None,
+                            photo_plaque_path=None,
+                            audio_path=None,
+                        )
+                        st.session_state[f"modal_open_{idx}"] = False
+                        st.success("✅ Proposition envoyée !")
+                        st.balloons()
+                        st.rerun()
+
     st.divider()
 
     with st.expander("➕ Moteur totalement hors liste"):
@@ -2132,7 +2666,7 @@ def render_analyse():
         with col1:
             dispo_marque = dispo[dispo["marque"].notna() & (dispo["marque"] != "")]
             if not dispo_marque.empty:
-                s = dispo_marque.groupby("marque")["n"].sum().sort_values(ascending=False).head(15).reset_index()
+                s = dispo_marque.groupby("marque", observed=True)["n"].sum().nlargest(15).reset_index()
                 fig = px.bar(s, x="marque", y="n", title="Top 15 marques en stock", labels={"marque": "Marque", "n": "Quantité"})
                 fig.update_traces(marker_color=COLORS["primary"])
                 fig.update_layout(template="plotly_white")
@@ -2141,15 +2675,15 @@ def render_analyse():
         with col2:
             dispo_energie = dispo[dispo["energie"].notna() & (dispo["energie"] != "")]
             if not dispo_energie.empty:
-                s = dispo_energie.groupby("energie")["n"].sum().reset_index()
+                s = dispo_energie.groupby("energie", observed=True)["n"].sum().reset_index()
                 fig = px.pie(s, values="n", names="energie", title="Répartition par énergie")
                 fig.update_traces(textposition="inside", textinfo="percent+label")
                 fig.update_layout(template="plotly_white")
                 st.plotly_chart(fig, use_container_width=True)
 
         prix = get_prix_achat_dispo(limit=200000)
-        if not prix.empty:
-            fig = px.histogram(prix, x="prix", nbins=40, title="Distribution des prix d'achat", labels={"prix": "Prix d'achat (€)", "count": "Fréquence"})
+        if prix.size:
+            fig = px.histogram(x=prix, nbins=40, title="Distribution des prix d'achat", labels={"x": "Prix d'achat (€)", "count": "Fréquence"})
             fig.update_traces(marker_color=COLORS["success"])
             fig.update_layout(template="plotly_white")
             st.plotly_chart(fig, use_container_width=True)
@@ -2158,8 +2692,11 @@ def render_analyse():
         st.markdown("### Évolution des prix")
         n_months = st.slider("Période (mois)", 3, 36, 12, 1, key="prix_n_months")
 
-        achats = get_prix_achat_par_mois(n_months)
-        ventes = get_prix_vente_par_mois(n_months)
+        res = run_parallel({
+            "achats": lambda: get_prix_achat_par_mois(n_months),
+            "ventes": lambda: get_prix_vente_par_mois(n_months),
+        })
+        achats, ventes = res["achats"], res["ventes"]
         df_global = pd.merge(achats, ventes, on="mois", how="outer").sort_values("mois")
 
         if not df_global.empty:
@@ -2187,15 +2724,18 @@ def render_analyse():
         with col3:
             topk = st.selectbox("Top affiché", [10, 20, 30, 50], index=1)
 
-        movers_achat = get_price_movers("achat", window_months=window, lookback_months=max(12, window * 4), min_count=minc)
-        movers_vente = get_price_movers("vente", window_months=window, lookback_months=max(12, window * 4), min_count=minc)
-
-        code_info = get_code_info()
+        lb = max(12, window * 4)
+        res = run_parallel({
+            "achat": lambda: get_price_movers("achat", window_months=window, lookback_months=lb, min_count=minc),
+            "vente": lambda: get_price_movers("vente", window_months=window, lookback_months=lb, min_count=minc),
+            "info": get_code_info_maps,
+        })
+        movers_achat, movers_vente, code_info_maps = res["achat"], res["vente"], res["info"]
 
         def enrich(df: pd.DataFrame) -> pd.DataFrame:
             if df is None or df.empty:
                 return df
-            out = df.merge(code_info, on="code_moteur", how="left")
+            out = df.assign(**{col: df["code_moteur"].map(m) for col, m in code_info_maps.items()})
             cols = [
                 "code_moteur", "marque", "energie", "type_nom", "type_modele", "type_annee",
                 "n_recent", "n_prev", "avg_prev", "avg_recent", "delta", "pct",
@@ -2211,39 +2751,41 @@ def render_analyse():
         with col4:
             st.markdown("#### 🔺 Achats - Hausses")
             if not movers_achat_e.empty:
-                up = movers_achat_e.sort_values("pct", ascending=False).head(int(topk))
+                up = movers_achat_e.nlargest(int(topk), "pct")
                 st.dataframe(up, use_container_width=True, height=300)
 
             st.markdown("#### 🔻 Achats - Baisses")
             if not movers_achat_e.empty:
-                down = movers_achat_e.sort_values("pct", ascending=True).head(int(topk))
+                down = movers_achat_e.nsmallest(int(topk), "pct")
                 st.dataframe(down, use_container_width=True, height=300)
 
         with col5:
             st.markdown("#### 🔺 Ventes - Hausses")
             if not movers_vente_e.empty:
-                up = movers_vente_e.sort_values("pct", ascending=False).head(int(topk))
+                up = movers_vente_e.nlargest(int(topk), "pct")
                 st.dataframe(up, use_container_width=True, height=300)
 
             st.markdown("#### 🔻 Ventes - Baisses")
             if not movers_vente_e.empty:
-                down = movers_vente_e.sort_values("pct", ascending=True).head(int(topk))
+                down = movers_vente_e.nsmallest(int(topk), "pct")
                 st.dataframe(down, use_container_width=True, height=300)
 
         st.divider()
         st.markdown("### Détail par code moteur")
 
-        candidates = []
-        if not movers_achat_e.empty:
-            candidates += movers_achat_e.sort_values("pct", ascending=False)["code_moteur"].head(200).tolist()
-        if not movers_vente_e.empty:
-            candidates += movers_vente_e.sort_values("pct", ascending=False)["code_moteur"].head(200).tolist()
-        candidates = sorted(list(dict.fromkeys([c for c in candidates if c])))
+        # Dédoublonnage + tri en vectorisé (pd.unique / np.sort) sur les deux tops
+        tops = [m.nlargest(200, "pct")["code_moteur"].to_numpy() for m in (movers_achat_e, movers_vente_e) if not m.empty]
+        codes = pd.unique(np.concatenate(tops)) if tops else np.array([], dtype=object)
+        codes = codes[pd.notna(codes) & (codes != "")]
+        candidates = np.sort(codes).tolist()
 
         if candidates:
             code = st.selectbox("Choisir un code moteur", candidates)
-            achats_code = get_prix_achat_par_mois_code(n_months, code)
-            ventes_code = get_prix_vente_par_mois_code(n_months, code)
+            # Préchargement de tous les candidats en 2 requêtes : changer de code
+            # dans la liste ne relance plus de requête (cache du lot).
+            batch = tuple(candidates)
+            achats_code = get_prix_achat_par_mois_code(n_months, code, batch)
+            ventes_code = get_prix_vente_par_mois_code(n_months, code, batch)
             df_code = pd.merge(achats_code, ventes_code, on="mois", how="outer").sort_values("mois")
 
             if not df_code.empty:
@@ -2266,17 +2808,116 @@ def render_analyse():
             st.markdown("#### Offres ciblées")
             df_off = get_recent_click_offers(limit=200)
             st.dataframe(df_off, use_container_width=True, height=400)
+            if not df_off.empty:
+                off_id = st.selectbox("🔎 Détail d'une offre", [None] + df_off["id"].tolist(), key="off_click_detail",
+                                      format_func=lambda x: "—" if x is None else f"#{x}")
+                if off_id is not None:
+                    st.dataframe(get_click_offer_details(off_id).T, use_container_width=True)
 
         with col7:
             st.markdown("#### Offres libres")
             df_free = get_recent_free_offers(limit=200)
             st.dataframe(df_free, use_container_width=True, height=400)
+            if not df_free.empty:
+                free_id = st.selectbox("🔎 Détail d'une offre", [None] + df_free["id"].tolist(), key="off_free_detail",
+                                       format_func=lambda x: "—" if x is None else f"#{x}")
+                if free_id is not None:
+                    st.dataframe(get_free_offer_details(free_id).T, use_container_width=True)
 
 
-def render_mise_a_jour_prix():
-    import numpy as np
-    import re
+def read_excel_fast(src) -> pd.DataFrame:
+    # calamine (python-calamine, Rust) : bien plus rapide et léger qu'openpyxl ;
+    # openpyxl reste en secours si le paquet n'est pas installé.
+    try:
+        return pd.read_excel(src, engine="calamine")
+    except ImportError:
+        if hasattr(src, "seek"):
+            src.seek(0)
+        return pd.read_excel(src, engine="openpyxl")
 
+
+def _read_motor_mapper(file_bytes: bytes) -> dict:
+    try:
+        mot = read_excel_fast(io.BytesIO(file_bytes))
+    except Exception as e:
+        raise ValueError(f"Erreur lecture tbl MOTEURS : {e}") from e
+
+    if not {"N_TypeMoteur", "code_moteur"}.issubset(mot.columns):
+        raise ValueError("tbl MOTEURS doit contenir N_TypeMoteur et code_moteur")
+
+    mot2 = mot[["N_TypeMoteur", "code_moteur"]].copy()
+    mot2["N_TypeMoteur"] = pd.to_numeric(mot2["N_TypeMoteur"], errors="coerce")
+    mot2["code_moteur"] = (
+        mot2["code_moteur"]
+        .astype("string[pyarrow]")
+        .str.replace("\u00A0", " ", regex=False)
+        .str.strip()
+        .str.upper()
+    )
+    mot2 = mot2.dropna()
+    mot2["N_TypeMoteur"] = mot2["N_TypeMoteur"].astype(int)
+
+    # Code le plus fréquent par type : comptage en une passe, puis tri sur n
+    # (à égalité, le premier code par ordre alphabétique l'emporte, comme avant)
+    rep = (
+        mot2.value_counts(["N_TypeMoteur", "code_moteur"], sort=False)
+        .reset_index(name="n")
+        .sort_values(["n", "code_moteur"], ascending=[False, True], kind="stable")
+        .drop_duplicates("N_TypeMoteur")
+    )
+    return dict(zip(rep["N_TypeMoteur"].astype(str), rep["code_moteur"]))
+
+
+@st.cache_data(show_spinner=False)
+def load_catalog(cat_bytes: bytes, mot_bytes: bytes | None = None) -> tuple[pd.DataFrame, str]:
+    """
+    Catalogue prix lu, normalisé et mappé (code_moteur_join, mapping_status),
+    mis en cache sur le contenu des fichiers : les sliders de marge ne
+    relancent que le calcul des prix, pas la lecture des Excel.
+    Lève ValueError (message affichable) si un fichier est illisible ou incomplet.
+    """
+    try:
+        cat = read_excel_fast(io.BytesIO(cat_bytes))
+    except Exception as e:
+        raise ValueError(f"Erreur lecture catalogue : {e}") from e
+
+    possible_cols = [c for c in cat.columns if str(c).strip().lower() in ["type moteur", "type_moteur", "typemoteur"]]
+    if not possible_cols:
+        raise ValueError(f"Colonne 'Type moteur' introuvable. Colonnes : {list(cat.columns)}")
+
+    col_type = possible_cols[0]
+    cat = cat[cat[col_type].notna()].copy()
+
+    # Chaînes Arrow (pyarrow, cf. requirements.txt) : les trois opérations
+    # str tournent sur le tableau Arrow, sans objet str Python par cellule
+    cat["type_moteur_excel"] = (
+        cat[col_type]
+        .astype("string[pyarrow]")
+        .str.replace("\u00A0", " ", regex=False)
+        .str.strip()
+        .str.upper()
+    )
+
+    # Clé de jointure au même type que code_moteur côté SQL (string[pyarrow])
+    cat["code_moteur_join"] = pd.Series(pd.NA, index=cat.index, dtype="string[pyarrow]")
+    cat["mapping_status"] = "❌ Non mappé"
+
+    if mot_bytes is not None:
+        mapper = _read_motor_mapper(mot_bytes)
+
+        # Premier nombre du type moteur, extrait en une passe (str.extract) ;
+        # passage par l'entier pour ignorer les zéros de tête ("007" -> "7")
+        nums = cat["type_moteur_excel"].str.extract(r"(\d+)", expand=False)
+        cat["code_moteur_join"] = (
+            pd.to_numeric(nums, errors="coerce").astype("Int64").astype(str).map(mapper).astype("string[pyarrow]")
+        )
+
+        cat["mapping_status"] = np.where(cat["code_moteur_join"].notna(), "✅ Mappé", "❌ Introuvable")
+
+    return cat, col_type
+
+
+def render_mise_a_jour_prix():
     if st.button("⬅ Retour à l'accueil", use_container_width=False):
         set_page("home")
         st.rerun()
@@ -2339,102 +2980,66 @@ def render_mise_a_jour_prix():
         return
 
     try:
-        cat = pd.read_excel(file_cat, engine="openpyxl")
-    except Exception as e:
-        st.error(f"Erreur lecture catalogue : {e}")
+        cat, col_type = load_catalog(file_cat.getvalue(), None if file_mot is None else file_mot.getvalue())
+    except ValueError as e:
+        st.error(str(e))
         return
 
-    possible_cols = [c for c in cat.columns if str(c).strip().lower() in ["type moteur", "type_moteur", "typemoteur"]]
-    if not possible_cols:
-        st.error("Colonne 'Type moteur' introuvable.")
-        st.write(list(cat.columns))
-        return
-
-    col_type = possible_cols[0]
-    cat = cat[cat[col_type].notna()].copy()
-
-    cat["type_moteur_excel"] = (
-        cat[col_type]
-        .astype(str)
-        .str.replace("\u00A0", " ", regex=False)
-        .str.strip()
-        .str.upper()
-    )
-
-    cat["code_moteur_join"] = None
-    cat["mapping_status"] = "❌ Non mappé"
-
-    if file_mot is not None:
-        try:
-            mot = pd.read_excel(file_mot, engine="openpyxl")
-        except Exception as e:
-            st.error(f"Erreur lecture tbl MOTEURS : {e}")
-            return
-
-        if not {"N_TypeMoteur", "code_moteur"}.issubset(mot.columns):
-            st.error("tbl MOTEURS doit contenir N_TypeMoteur et code_moteur")
-            return
-
-        mot2 = mot[["N_TypeMoteur", "code_moteur"]].copy()
-        mot2["N_TypeMoteur"] = pd.to_numeric(mot2["N_TypeMoteur"], errors="coerce")
-        mot2["code_moteur"] = (
-            mot2["code_moteur"]
-            .astype(str)
-            .str.replace("\u00A0", " ", regex=False)
-            .str.strip()
-            .str.upper()
-        )
-        mot2 = mot2.dropna()
-        mot2["N_TypeMoteur"] = mot2["N_TypeMoteur"].astype(int)
-
-        rep = (
-            mot2.groupby(["N_TypeMoteur", "code_moteur"])
-            .size()
-            .reset_index(name="n")
-            .sort_values(["N_TypeMoteur", "n"], ascending=[True, False])
-            .drop_duplicates("N_TypeMoteur")
-        )
-        mapper = dict(zip(rep["N_TypeMoteur"].astype(str), rep["code_moteur"]))
-
-        def extract_int(s: str):
-            m = re.search(r"\d+", s or "")
-            return int(m.group(0)) if m else None
-
-        cat["_num"] = cat["type_moteur_excel"].apply(extract_int)
-        cat["code_moteur_join"] = cat["_num"].astype("Int64").astype(str).map(mapper)
-
-        cat["mapping_status"] = np.where(cat["code_moteur_join"].notna(), "✅ Mappé", "❌ Introuvable")
-        cat.drop(columns=["_num"], inplace=True)
-
-    besoins = get_besoins_moteurs(2000)
-    ventes3m = get_prix_vente_moy_code_3m()
+    res = run_parallel({
+        "besoins": lambda: get_besoins_moteurs(2000),
+        "ventes3m": get_prix_vente_moy_code_3m,
+    })
+    besoins, ventes3m = res["besoins"], res["ventes3m"]
 
     df = (
         cat.merge(besoins, left_on="code_moteur_join", right_on="code_moteur", how="left")
            .merge(ventes3m, left_on="code_moteur_join", right_on="code_moteur", how="left", suffixes=("", "_v3m"))
     )
 
-    for c in ["nb_vendus_3m", "nb_stock_dispo", "score_urgence", "prix_vente_moy_3m"]:
-        df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0)
-
-    df["f_urgence"] = (df["score_urgence"] / 8.0).clip(0, 1)
-    df["f_surstock"] = (df["nb_stock_dispo"] / (df["nb_vendus_3m"] + 1) / 5.0).clip(0, 1)
-
-    df["marge_effective"] = (marge_cible - bonus_urgence * df["f_urgence"] + malus_surstock * df["f_surstock"]).clip(0.05, 0.9)
-    df["prix_achat_propose"] = (df["prix_vente_moy_3m"] * (1 - df["marge_effective"])).round(0)
-
-    def decision(r):
-        if str(r["mapping_status"]).startswith("❌"):
-            return "❌ Pas de mapping"
-        if r["prix_vente_moy_3m"] == 0:
-            return "⚠️ Pas de ventes"
-        if r["score_urgence"] >= 5:
-            return "🔥 Monter prix"
-        if r["nb_stock_dispo"] >= 3 and r["nb_vendus_3m"] <= 1:
-            return "📦 Baisser prix"
-        return "✅ OK"
-
-    df["reco"] = df.apply(decision, axis=1)
+    # Conversion des 4 colonnes en un seul bloc float32 (moitié moins de mémoire
+    # à parcourir pour les calculs de marge qui suivent)
+    num_cols = ["nb_vendus_3m", "nb_stock_dispo", "score_urgence", "prix_vente_moy_3m"]
+    df[num_cols] = df[num_cols].apply(pd.to_numeric, errors="coerce").fillna(0.0).astype("float32")
+
+    # Calcul des marges sur les tableaux numpy, opérations en place (out=) :
+    # un tampon par colonne produite, sans Series intermédiaire à chaque étape
+    u = df["score_urgence"].to_numpy()
+    stock = df["nb_stock_dispo"].to_numpy()
+    vendus = df["nb_vendus_3m"].to_numpy()
+    pv = df["prix_vente_moy_3m"].to_numpy()
+
+    f_urgence = np.divide(u, 8.0)
+    np.clip(f_urgence, 0, 1, out=f_urgence)
+    f_surstock = np.add(vendus, 1)
+    np.divide(stock, f_surstock, out=f_surstock)
+    f_surstock /= 5.0
+    np.clip(f_surstock, 0, 1, out=f_surstock)
+
+    marge = np.multiply(f_surstock, malus_surstock)
+    marge -= bonus_urgence * f_urgence
+    marge += marge_cible
+    np.clip(marge, 0.05, 0.9, out=marge)
+
+    prix_achat = np.subtract(1, marge)
+    prix_achat *= pv
+    np.round(prix_achat, 0, out=prix_achat)
+
+    df["f_urgence"] = f_urgence
+    df["f_surstock"] = f_surstock
+    df["marge_effective"] = marge
+    df["prix_achat_propose"] = prix_achat
+
+    # Recommandation vectorisée : np.select garde le premier masque vrai,
+    # dans le même ordre de priorité que l'ancienne cascade if/elif par ligne
+    m_nomap = df["mapping_status"].astype(str).str.startswith("❌").to_numpy(dtype=bool)
+    m_novente = df["prix_vente_moy_3m"].to_numpy() == 0
+    m_urgent = df["score_urgence"].to_numpy() >= 5
+    m_surstock = (df["nb_stock_dispo"].to_numpy() >= 3) & (df["nb_vendus_3m"].to_numpy() <= 1)
+    df["reco"] = np.select(
+        [m_nomap, m_novente, m_urgent, m_surstock],
+        ["❌ Pas de mapping", "⚠️ Pas de ventes", "🔥 Monter prix", "📦 Baisser prix"],
+        default="✅ OK",
+    )
 
     st.dataframe(
         df[[col_type, "type_moteur_excel", "code_moteur_join", "mapping_status",
@@ -2456,6 +3061,8 @@ def init_db_once() -> bool:
     # Tout ce qui était relancé à chaque rerun passe ici.
     assert_db_ready()
     ensure_stock_views()
+    ensure_stock_agg()
+    ensure_indexes()
     ensure_breaker_tables()
     return True
 
@@ -2499,7 +3106,8 @@ def main():
     )
 
     if page == "home":
-        kpis = get_kpis_stock()
+        all_kpis = get_all_kpis()
+        kpis = all_kpis["moteurs"]
         col1, col2, col3 = st.columns(3)
 
         with col1:
@@ -2532,7 +3140,7 @@ def main():
 
         md_html("<br>")
 
-        kpis_boites = get_kpis_boites()
+        kpis_boites = all_kpis["boites"]
         colb1, colb2, colb3 = st.columns(3)
 
         with colb1:
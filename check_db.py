@@ -8,7 +8,10 @@ def q(sql):
     with sqlite3.connect(DB_PATH) as c:
         return pd.read_sql_query(sql, c)
 
-print(q("SELECT COUNT(*) as n FROM tbl_MOTEURS"))
-print(q("SELECT COUNT(*) as n FROM tbl_Types_moteurs"))
-print(q("SELECT COUNT(*) as n FROM tbl_Marques"))
-print(q("SELECT COUNT(*) as n FROM tbl_EXPEDITIONS_moteurs"))
+print(q("""
+SELECT
+  (SELECT COUNT(*) FROM tbl_MOTEURS) AS n_moteurs,
+  (SELECT COUNT(*) FROM tbl_Types_moteurs) AS n_types_moteurs,
+  (SELECT COUNT(*) FROM tbl_Marques) AS n_marques,
+  (SELECT COUNT(*) FROM tbl_EXPEDITIONS_moteurs) AS n_expeditions_moteurs
+""").T)
@@ -1,11 +1,14 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 
 DATA_DIR = Path("data")
 DB_DIR = Path("db")
 DB_DIR.mkdir(exist_ok=True)
 DB_PATH = DB_DIR / "dms.sqlite"
+READ_WORKERS = max(1, (os.cpu_count() or 2) - 1)
 
 def sanitize_table_name(stem: str) -> str:
     name = stem.strip()
@@ -14,21 +17,35 @@ def sanitize_table_name(stem: str) -> str:
                 .replace("à", "a").replace("ç", "c"))
     return name
 
+def read_first_sheet(f: Path) -> pd.DataFrame:
+    return pd.read_excel(f, sheet_name=0, engine="calamine")
+
+def fast_bulk_pragmas(dbapi_conn, _record):
+    # Import one-shot : la base est reconstruite depuis les Excel en cas de crash,
+    # on peut donc se passer du fsync et du journal disque pendant le chargement.
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA synchronous = OFF")
+    cur.execute("PRAGMA journal_mode = MEMORY")
+    cur.execute("PRAGMA temp_store = MEMORY")
+    cur.close()
+
 def main():
     engine = create_engine(f"sqlite:///{DB_PATH}")
+    event.listen(engine, "connect", fast_bulk_pragmas)
 
     files = sorted(DATA_DIR.glob("*.xlsx"))
     if not files:
         raise SystemExit(f"Aucun .xlsx dans {DATA_DIR.resolve()}")
 
-    for f in files:
-        xl = pd.ExcelFile(f)
-        sheet = xl.sheet_names[0]
-        df = pd.read_excel(f, sheet_name=sheet, engine="openpyxl")
-
-        table = sanitize_table_name(f.stem)
-        df.to_sql(table, engine, if_exists="replace", index=False)
-        print(f"✅ {f.name} -> {table} ({len(df)} lignes, {df.shape[1]} colonnes)")
+    # Décodage des Excel en parallèle dans des process séparés (CPU-bound,
+    # le GIL limitait les threads) ; l'écriture SQLite reste séquentielle
+    # (un seul writer) et dans l'ordre des fichiers, sur une seule connexion
+    # et une seule transaction pour tout l'import.
+    with ProcessPoolExecutor(max_workers=READ_WORKERS) as pool, engine.begin() as conn:
+        for f, df in zip(files, pool.map(read_first_sheet, files)):
+            table = sanitize_table_name(f.stem)
+            df.to_sql(table, conn, if_exists="replace", index=False)
+            print(f"✅ {f.name} -> {table} ({len(df)} lignes, {df.shape[1]} colonnes)")
 
     print(f"\nDB prête: {DB_PATH.resolve()}")
 
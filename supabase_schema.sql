@@ -4,6 +4,7 @@
 -- ============================================
 
 -- Supprimer les tables existantes (dans l'ordre des dépendances)
+DROP MATERIALIZED VIEW IF EXISTS mv_moteurs_dispo_agg;
 DROP VIEW IF EXISTS v_moteurs_dispo CASCADE;
 DROP VIEW IF EXISTS v_boites_dispo CASCADE;
 
@@ -201,6 +202,10 @@ CREATE TABLE tbl_moteurs (
 CREATE INDEX idx_moteurs_code ON tbl_moteurs(code_moteur);
 CREATE INDEX idx_moteurs_reception ON tbl_moteurs(num_reception);
 CREATE INDEX idx_moteurs_expedition ON tbl_moteurs(n_expedition);
+-- Les requêtes filtrent / groupent sur UPPER(code_moteur) ; index partiel :
+-- chaque requête qui s'en sert répète le prédicat WHERE ci-dessous
+CREATE INDEX idx_moteurs_code_upper ON tbl_moteurs (UPPER(code_moteur))
+    WHERE code_moteur IS NOT NULL AND TRIM(code_moteur) <> '';
 
 CREATE TABLE tbl_boites (
     n_bv INTEGER PRIMARY KEY,
@@ -233,7 +238,7 @@ CREATE TABLE tbl_expeditions_moteurs (
     date_validation TIMESTAMP
 );
 
-CREATE INDEX idx_exp_moteurs_date ON tbl_expeditions_moteurs(date_validation);
+CREATE INDEX idx_exp_moteurs_date ON tbl_expeditions_moteurs(date_validation) INCLUDE (n_moteur, prix_vente_moteur);
 CREATE INDEX idx_exp_moteurs_moteur ON tbl_expeditions_moteurs(n_moteur);
 
 CREATE TABLE tbl_expeditions_boites (
@@ -374,5 +379,30 @@ FROM tbl_boites b;
 -- ALTER TABLE tbl_moteurs ENABLE ROW LEVEL SECURITY;
 -- CREATE POLICY "Allow all" ON tbl_moteurs FOR ALL USING (true);
 
+-- ============================================
+-- AGRÉGATS MATÉRIALISÉS
+-- ============================================
+
+-- Stock disponible par code / marque / énergie (lu par l'app à la place de v_moteurs_dispo)
+CREATE MATERIALIZED VIEW mv_moteurs_dispo_agg AS
+SELECT
+    COALESCE(UPPER(code_moteur), '') AS code_moteur,
+    COALESCE(marque, '') AS marque,
+    COALESCE(energie, '') AS energie,
+    COUNT(*) AS n
+FROM v_moteurs_dispo
+WHERE est_disponible = 1
+  AND (archiver IS NULL OR archiver = TRUE)
+GROUP BY 1, 2, 3;
+
+-- Index unique requis pour REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE UNIQUE INDEX idx_mv_moteurs_dispo_agg ON mv_moteurs_dispo_agg (code_moteur, marque, energie);
+
+-- Rafraîchissement nocturne par pg_cron (l'app ne fait que lire la vue).
+-- Job nommé : cron.schedule le remplace s'il existe déjà.
+CREATE EXTENSION IF NOT EXISTS pg_cron;
+SELECT cron.schedule('refresh_mv_moteurs_dispo_agg', '0 3 * * *',
+  'REFRESH MATERIALIZED VIEW CONCURRENTLY mv_moteurs_dispo_agg');
+
 COMMENT ON VIEW v_moteurs_dispo IS 'Vue des moteurs avec statut de disponibilité';
 COMMENT ON VIEW v_boites_dispo IS 'Vue des boîtes avec statut de disponibilité';